@@ -17,6 +17,8 @@ class Agent():
     def __init__(self, id, args, train_dataset=None, data_idxs=None):
         self.id = id
         self.args = args
+        # updates are stored in this dtype, float32 unless a smaller storage type is asked for
+        self.update_dtype = getattr(torch, args.update_dtype)
         if self.id < args.num_corrupt:
             self.malicious = True
             self.attack_start_round = args.attack_start_round
@@ -31,14 +33,14 @@ class Agent():
             # size of local dataset
             self.n_data = len(self.train_dataset)
         
-    def local_reddit_train(self, global_model, criterion, rnd, data_dict, sampling):
+    def local_reddit_train(self, global_model, criterion, rnd, data_dict, sampling, initial_params = None, update_out = None):
         train_data = data_dict['train_data'][sampling[self.id]]
         ntokens = data_dict['n_tokens']
         hidden = global_model.init_hidden(self.args.bs)
 
         poisoned_data = data_dict['poisoned_data_for_train']
         bptt = 64
-        initial_vector = parameters_to_vector(global_model.parameters()).detach()
+        initial_vector = self.initial_parameters(global_model, initial_params)
         if self.malicious == True and rnd >= self.attack_start_round:
             optimizer = torch.optim.SGD(global_model.parameters(), lr=self.args.poison_lr,
                             momentum=self.args.client_moment)
@@ -81,28 +83,30 @@ class Agent():
                     torch.nn.utils.clip_grad_norm_(global_model.parameters(), 0.25)
                     optimizer.step()
 
-        with torch.no_grad():
-            update = parameters_to_vector(global_model.parameters()).double() - initial_vector
-            return update
+        return self.compute_update(global_model, initial_vector, update_out)
 
 
-    def local_train(self, global_model, criterion, rnd, trigger_model = None):
+    def local_train(self, global_model, criterion, rnd, trigger_model = None, initial_params = None, update_out = None):
+        """ 
+        initial_params is the flat copy of the received global model if the caller already holds one,
+        update_out a preallocated buffer the update is written into instead of a fresh tensor
+        """
         if self.malicious == False or rnd < self.attack_start_round:
-            return self.local_benign_train(global_model, criterion)
+            return self.local_benign_train(global_model, criterion, initial_params, update_out)
 
         elif self.args.attack_mode == 'normal' or self.args.attack_mode == 'DBA':
-            return self.local_normal_malicious_train(global_model, criterion)
+            return self.local_normal_malicious_train(global_model, criterion, initial_params, update_out)
 
         elif self.args.attack_mode == 'trigger_generation' or self.args.attack_mode == 'fixed_generator':
-            return self.local_malicious_train_trigger_generation(global_model, criterion, trigger_model)
+            return self.local_malicious_train_trigger_generation(global_model, criterion, trigger_model, initial_params, update_out)
         
     
 
-    def local_malicious_train_trigger_generation(self, global_model, criterion, trigger_model):
-        initial_global_model_params = parameters_to_vector(global_model.parameters()).detach()
+    def local_malicious_train_trigger_generation(self, global_model, criterion, trigger_model, initial_params = None, update_out = None):
+        initial_global_model_params = self.initial_parameters(global_model, initial_params)
         #benign_update = self.local_common_train(global_model, criterion, malicious_mode = False)
 
-        vector_to_parameters(copy.deepcopy(initial_global_model_params), global_model.parameters())
+        functions.load_parameters(global_model, initial_global_model_params)
 
         if self.args.attack_mode == 'trigger_generation':
             noise_generator_using = trigger_model[0]
@@ -217,24 +221,21 @@ class Agent():
                     noise_generator_using.load_state_dict(noise_generator_target.state_dict())
                 else:
                     noise_vector_using.data = noise_vector_target.data
-        with torch.no_grad():
-            update = parameters_to_vector(global_model.parameters()).double() - initial_global_model_params
-
-        return update
+        return self.compute_update(global_model, initial_global_model_params, update_out)
 
 
-    def local_benign_train(self, global_model,criterion):
-        return self.local_common_train(global_model, criterion, malicious_mode = False)
+    def local_benign_train(self, global_model,criterion, initial_params = None, update_out = None):
+        return self.local_common_train(global_model, criterion, malicious_mode = False, initial_params = initial_params, update_out = update_out)
 
 
-    def local_normal_malicious_train(self, global_model, criterion):
-        return self.local_common_train(global_model, criterion, malicious_mode = True)
+    def local_normal_malicious_train(self, global_model, criterion, initial_params = None, update_out = None):
+        return self.local_common_train(global_model, criterion, malicious_mode = True, initial_params = initial_params, update_out = update_out)
             
 
 
-    def local_common_train(self, global_model, criterion, malicious_mode = False):
+    def local_common_train(self, global_model, criterion, malicious_mode = False, initial_params = None, update_out = None):
         """ Do a local training over the received global model, return the update """
-        initial_global_model_params = parameters_to_vector(global_model.parameters()).detach()
+        initial_global_model_params = self.initial_parameters(global_model, initial_params)
         global_model.train()
         
         if malicious_mode == True:
@@ -256,6 +257,9 @@ class Agent():
             mode = 'malicious'
         else:
             mode = 'benign'
+        # parameters and their received values, tensor by tensor, for the projection after every step
+        local_params = list(global_model.parameters())
+        initial_param_views = functions.split_like_parameters(initial_global_model_params, global_model)
 
         for _ in range(current_epoch_num):
             for inputs_benign, labels_benign, inputs_malicious, labels_malicious in data_loader.enumerate_batch(self.train_dataset, mode, self.args.bs, self.args):
@@ -284,19 +288,30 @@ class Agent():
             
                 # doing projected gradient descent to ensure the update is within the norm bounds 
                 if self.args.clip > 0:
-                    with torch.no_grad():
-                        local_model_params = parameters_to_vector(global_model.parameters())
-                        update = local_model_params - initial_global_model_params
-                        clip_denom = max(1, torch.norm(update, p=2)/self.args.clip)
-                        update.div_(clip_denom)
-                        vector_to_parameters(initial_global_model_params + update, global_model.parameters())
+                    functions.project_parameters(local_params, initial_param_views, self.args.clip)
 
             if malicious_mode == True and self.args.step_lr == True:
                 scheduler.step()
                             
+        return self.compute_update(global_model, initial_global_model_params, update_out)
+
+    def initial_parameters(self, global_model, initial_params = None):
+        if initial_params is not None:
+            return initial_params
+        return parameters_to_vector(global_model.parameters()).detach()
+
+    def compute_update(self, global_model, initial_global_model_params, update_out = None):
+        """ difference between the trained and the received parameters, cast to the update dtype """
         with torch.no_grad():
-            update = parameters_to_vector(global_model.parameters()).double() - initial_global_model_params
-            return update
+            if update_out is None:
+                update = parameters_to_vector(global_model.parameters()) - initial_global_model_params
+                return update.to(self.update_dtype)
+            # written tensor by tensor, so no concatenated copy of the parameters is made
+            for param, initial_param, out in zip(global_model.parameters(),
+                    functions.split_like_parameters(initial_global_model_params, global_model),
+                    functions.split_like_parameters(update_out, global_model)):
+                torch.sub(param, initial_param, out=out)
+            return update_out
         
 
 
@@ -1,10 +1,13 @@
 import torch
 import models
+import functions
 from torch.nn.utils import vector_to_parameters, parameters_to_vector
 import numpy as np
 from copy import deepcopy
 from torch.nn import functional as F
 from defence import *
+from update_geometry import UpdateGeometry
+from sketch import make_sketcher, exact_row_euclidean, krum_borderline
 class Aggregation():
     def __init__(self, agent_data_sizes, n_params, args, writer):
         self.agent_data_sizes = agent_data_sizes
@@ -12,11 +15,27 @@ class Aggregation():
         self.writer = writer
         self.server_lr = args.server_lr
         self.n_params = n_params
+        # updates may be stored in half precision, sums and norms over them are taken in accum_dtype
+        if args.update_dtype == 'float64':
+            self.accum_dtype = torch.float64
+        else:
+            self.accum_dtype = torch.float32
 
         self.cum_net_mov = 0
+        # krum and flame may decide on random-projection sketches of the updates, taken as they arrive
+        self.sketcher = None
+        if args.sketch != 'none':
+            if args.aggr != 'krum' and args.aggr != 'flame':
+                raise ValueError('--sketch only applies to krum and flame, got aggr {}'.format(args.aggr))
+            self.sketcher = make_sketcher(n_params, args)
+        if args.aggr == 'flame' and hdbscan is None:
+            raise ImportError('flame needs the hdbscan package')
+        self.start_round()
         
          
     def aggregate_updates(self, global_model, agent_updates_dict, cur_round):
+        # distances between the round's updates, computed on first use by whichever defence needs them
+        self.geometry = None
         # adjust LR if robust LR is selected
         lr_vector = torch.Tensor([self.server_lr]*self.n_params).to(self.args.device)
         if self.args.robustLR_threshold > 0:
@@ -32,113 +51,230 @@ class Aggregation():
             aggregated_updates = self.agg_avg(agent_updates_dict)
         elif self.args.aggr=='comed':
             aggregated_updates = self.agg_comed(agent_updates_dict)
+        elif self.args.aggr == 'trimmed_mean':
+            aggregated_updates = self.agg_trimmed_mean(agent_updates_dict)
+        elif self.args.aggr == 'winsorized_mean':
+            aggregated_updates = self.agg_winsorized_mean(agent_updates_dict)
         elif self.args.aggr == 'sign':
             aggregated_updates = self.agg_sign(agent_updates_dict)
         elif self.args.aggr == 'krum':
             aggregated_updates = self.multi_krum(agent_updates_dict)
         elif self.args.aggr == 'flame':
             aggregated_updates = self.agg_flame(agent_updates_dict)
+        self.apply_aggregated_updates(global_model, aggregated_updates, lr_vector)
+        self.geometry = None
+        self.sketches = {}
+        
+        # some plotting stuff if desired
+        # self.plot_sign_agreement(lr_vector, cur_global_params, new_global_params, cur_round)
+        # self.plot_norms(agent_updates_dict, cur_round)
+        return           
+
+    def apply_aggregated_updates(self, global_model, aggregated_updates, lr_vector):
         if self.args.noise > 0:
             aggregated_updates.add_(torch.normal(mean=0, std=self.args.noise*self.args.clip, size=(self.n_params,)).to(self.args.device))
         
                 
         cur_global_params = parameters_to_vector(global_model.parameters())
         new_global_params =  (cur_global_params + lr_vector*aggregated_updates).float() 
-        vector_to_parameters(new_global_params, global_model.parameters())
-        
-        # some plotting stuff if desired
-        # self.plot_sign_agreement(lr_vector, cur_global_params, new_global_params, cur_round)
-        # self.plot_norms(agent_updates_dict, cur_round)
-        return           
+        # in place, so parameters that are views of a flat buffer stay views of it
+        functions.load_parameters(global_model, new_global_params)
+
+    def supports_streaming(self):
+        """ avg and sign only need running sums, so their updates can be folded in as they arrive """
+        return self.args.aggr == 'avg' or self.args.aggr == 'sign'
+
+    def start_round(self):
+        """ resets the running sums of the streaming path """
+        self.sm_updates, self.total_data = None, 0
+        self.sm_signs = None
+        self.sketches = {}
+
+    def sketch_update(self, _id, update, cur_round):
+        """ keeps the sketch of an update of the non-streaming path, if the defence works on sketches """
+        if self.sketcher != None:
+            self.sketches[_id] = self.sketcher.sketch(update, cur_round)
+
+    def has_sketches(self, agent_updates_dict):
+        return self.sketcher != None and all(_id in self.sketches for _id in agent_updates_dict.keys())
+
+    def accumulate_update(self, _id, update):
+        """ folds one agent's update into the running weighted sum and sign count of the round """
+        if self.args.clip != 0:
+            l2_update = self.update_norm(update)
+            update.div_(max(1, l2_update/self.args.clip))
+
+        if self.args.aggr == 'avg':
+            n_agent_data = self.agent_weight(_id)
+            if self.sm_updates is None:
+                self.sm_updates = torch.zeros(update.shape, dtype=self.accum_dtype, device=update.device)
+            self.sm_updates.add_(update, alpha=n_agent_data)
+            self.total_data += n_agent_data
+
+        if self.args.aggr == 'sign' or self.args.robustLR_threshold > 0:
+            if self.sm_signs is None:
+                self.sm_signs = torch.zeros(update.shape, dtype=torch.int32, device=update.device)
+            self.sm_signs.add_(torch.sign(update).to(torch.int32))
+
+    def aggregate_streamed_updates(self, global_model, cur_round):
+        """ same as aggregate_updates, but from the running sums filled by accumulate_update """
+        lr_vector = torch.Tensor([self.server_lr]*self.n_params).to(self.args.device)
+        if self.args.robustLR_threshold > 0:
+            lr_vector = self.robustLR_from_signs(self.sm_signs)
+
+        if self.args.aggr == 'avg':
+            aggregated_updates = self.sm_updates / self.total_data
+        elif self.args.aggr == 'sign':
+            aggregated_updates = torch.sign(self.sm_signs).float()
+
+        self.apply_aggregated_updates(global_model, aggregated_updates, lr_vector)
+        self.start_round()
+        return
      
     
     def compute_robustLR(self, agent_updates_dict):
-        agent_updates_sign = [torch.sign(update) for update in agent_updates_dict.values()]  
-        sm_of_signs = torch.abs(sum(agent_updates_sign))
+        agent_updates_sign = [torch.sign(update).to(torch.int32) for update in agent_updates_dict.values()]  
+        return self.robustLR_from_signs(sum(agent_updates_sign))
+
+    def robustLR_from_signs(self, sm_of_signs):
+        sm_of_signs = torch.abs(sm_of_signs).float()
         
         sm_of_signs[sm_of_signs < self.args.robustLR_threshold] = -self.server_lr
         sm_of_signs[sm_of_signs >= self.args.robustLR_threshold] = self.server_lr                                            
         return sm_of_signs.to(self.args.device)
         
+    def compute_krum_scores(self, agent_updates_dict):
+        """ returns the agent ids, their stacked [n, d] updates and the krum score of every agent """
+        agent_ids, geometry = self.round_geometry(agent_updates_dict)
+        stacked_updates = geometry.stacked_updates
+        scores = krum_scores(geometry.euclidean(), self.args.krum_tolerance_number)
+        self.last_krum_scores = dict(zip(agent_ids, scores.tolist()))
+        return agent_ids, stacked_updates, scores
+
+    def round_geometry(self, agent_updates_dict):
+        """ the agent ids and the UpdateGeometry of the round's stacked updates, built once and shared by every defence """
+        if self.geometry == None:
+            self.geometry_ids = list(agent_updates_dict.keys())
+            stacked_updates = torch.stack([agent_updates_dict[_id] for _id in self.geometry_ids], dim=0)
+            self.geometry = UpdateGeometry(stacked_updates, self.args.aggr_block_size)
+        return self.geometry_ids, self.geometry
+
     def multi_krum(self, agent_updates_dict):
         selected_number = self.args.krum_selected_number
-        tolerance_number = self.args.krum_tolerance_number
         update_len = len(agent_updates_dict.keys())
         #aggregation method is averaging in this case
         if selected_number >= update_len:
-            return self.agg_avg(self, agent_updates_dict)
+            return self.agg_avg(agent_updates_dict)
+        elif self.has_sketches(agent_updates_dict):
+            return self.sketched_multi_krum(agent_updates_dict)
         else:
-            # Compute list of scores
-            scores = [list() for i in range(update_len)]
-            for i in range(update_len - 1):
-                score = scores[i]
-                for j in range(i + 1, update_len):
-                     # With: 0 <= i < j < nbworkers
-                    distance = torch.dist(agent_updates_dict[i], agent_updates_dict[j]).item()
-                    #if distance == float('nan'):
-                        #distance = float('inf')
-                    score.append(distance)
-                    scores[j].append(distance)
-            nbinscore = update_len - tolerance_number - 2
-            for i in range(update_len):
-                score = scores[i]
-                score.sort()
-                scores[i] = sum(score[:nbinscore])
-            # Return the average of the m gradients with the smallest score
-            pairs = [(agent_updates_dict[i], scores[i]) for i in range(update_len)]
-            pairs.sort(key=lambda pair: pair[1])
-            result = pairs[0][0]
-            for i in range(1, selected_number):
-                result += pairs[i][0]
-            result /= float(selected_number)
-            return result
+            _, stacked_updates, scores = self.compute_krum_scores(agent_updates_dict)
+            # Return the average of the m updates with the smallest score
+            selected = torch.topk(scores, selected_number, largest=False).indices
+            return stacked_updates[selected].to(self.accum_dtype).mean(dim=0)
+
+    def sketched_multi_krum(self, agent_updates_dict):
+        """ multi krum scored on the sketches, only the rows near the selection boundary get their exact distances """
+        selected_number = self.args.krum_selected_number
+        agent_ids = list(agent_updates_dict.keys())
+        updates = [agent_updates_dict[_id] for _id in agent_ids]
+        sketch_geometry = UpdateGeometry(torch.stack([self.sketches[_id] for _id in agent_ids], dim=0))
+        scores = krum_scores(sketch_geometry.euclidean(), self.args.krum_tolerance_number)
+        certain, borderline = krum_borderline(scores, selected_number, self.sketcher.eps)
+        selected = certain.tolist()
+        # the sketched scores of every agent, and apart from them the exact scores of the borderline agents
+        self.last_krum_scores = dict(zip(agent_ids, scores.tolist()))
+        self.last_exact_krum_scores = {}
+        if len(selected) < selected_number:
+            rows = borderline.to(updates[0].device)
+            exact_distances = exact_row_euclidean(updates, rows, self.args.aggr_block_size)
+            exact_scores = krum_scores(exact_distances, self.args.krum_tolerance_number, rows)
+            best = torch.topk(exact_scores, selected_number - len(selected), largest=False).indices
+            selected += rows[best].tolist()
+            self.last_exact_krum_scores = {agent_ids[row]: score for row, score in zip(rows.tolist(), exact_scores.tolist())}
+        return torch.stack([updates[i] for i in selected], dim=0).to(self.accum_dtype).mean(dim=0)
 
     def agg_avg(self, agent_updates_dict):
         """ classic fed avg """
-        sm_updates, total_data = 0, 0
+        sm_updates, total_data = torch.zeros(self.n_params, dtype=self.accum_dtype, device=self.args.device), 0
         for _id, update in agent_updates_dict.items():
-            if self.args.data != 'reddit':
-                n_agent_data = self.agent_data_sizes[_id]
-            else:
-                n_agent_data = 1
-            sm_updates +=  n_agent_data * update
+            n_agent_data = self.agent_weight(_id)
+            sm_updates.add_(update, alpha=n_agent_data)
             total_data += n_agent_data  
         return  sm_updates / total_data
+
+    def agent_weight(self, _id):
+        if self.args.data != 'reddit':
+            return self.agent_data_sizes[_id]
+        return 1
     
     def agg_comed(self, agent_updates_dict):
-        agent_updates_col_vector = [update.view(-1, 1) for update in agent_updates_dict.values()]
-        concat_col_vectors = torch.cat(agent_updates_col_vector, dim=1)
-        return torch.median(concat_col_vectors, dim=1).values
+        return chunked_coordinatewise(list(agent_updates_dict.values()), coordinatewise_median,
+            self.args.aggr_block_size, self.accum_dtype)
+
+    def agg_trimmed_mean(self, agent_updates_dict):
+        """ coordinate-wise mean after dropping the trim_ratio largest and smallest values """
+        trim_number = self.get_trim_number(len(agent_updates_dict))
+        return chunked_coordinatewise(list(agent_updates_dict.values()),
+            lambda block: trimmed_mean(block, trim_number), self.args.aggr_block_size, self.accum_dtype)
+
+    def agg_winsorized_mean(self, agent_updates_dict):
+        """ coordinate-wise mean after clamping the trim_ratio largest and smallest values """
+        trim_number = self.get_trim_number(len(agent_updates_dict))
+        return chunked_coordinatewise(list(agent_updates_dict.values()),
+            lambda block: winsorized_mean(block, trim_number), self.args.aggr_block_size, self.accum_dtype)
+
+    def get_trim_number(self, update_len):
+        # at least one value per coordinate has to survive the trimming
+        return min(int(self.args.trim_ratio * update_len), (update_len - 1) // 2)
     
     def agg_sign(self, agent_updates_dict):
         """ aggregated majority sign update """
-        agent_updates_sign = [torch.sign(update) for update in agent_updates_dict.values()]
+        agent_updates_sign = [torch.sign(update).to(torch.int32) for update in agent_updates_dict.values()]
         sm_signs = torch.sign(sum(agent_updates_sign))
-        return torch.sign(sm_signs)
+        return torch.sign(sm_signs).to(self.accum_dtype)
 
     def agg_flame(self, agent_updates_dict):
-        """ fed avg with flame """
-        update_len = len(agent_updates_dict.keys())
-        weights = np.zeros((update_len, np.array(len(agent_updates_dict[0]))))
-        for _id, update in agent_updates_dict.items():
-            weights[_id] = update.cpu().detach().numpy()  # np.array
-        # grad_in = weights.tolist()  #list
-        benign_id = flame(weights, cluster_sel=0)
-        accepted_models_dict = {}
-        for i in range(len(benign_id)):
-            accepted_models_dict[i] = torch.tensor(weights[benign_id[i], :]).to(self.args.device)
-        sm_updates, total_data = 0, 0
-        for _id, update in accepted_models_dict.items():
-            n_agent_data = self.agent_data_sizes[_id]
-            sm_updates += n_agent_data * update
-            total_data += n_agent_data
-        return sm_updates / total_data
+        """ 
+        fed avg with flame: hdbscan on the cosine distances of the updates, the accepted updates are
+        clipped to the median norm S of the round and gaussian noise of std flame_lambda * S is added
+        """
+        agent_ids = list(agent_updates_dict.keys())
+        if self.has_sketches(agent_updates_dict):
+            benign_id = sketched_flame(torch.stack([self.sketches[_id] for _id in agent_ids], dim=0),
+                [agent_updates_dict[_id] for _id in agent_ids], self.sketcher.eps, self.args.aggr_block_size)
+            norms = torch.stack([self.update_norm(agent_updates_dict[_id]) for _id in agent_ids])
+        else:
+            agent_ids, geometry = self.round_geometry(agent_updates_dict)
+            # the distances are computed on the device, only the n x n matrix goes to hdbscan
+            benign_id = flame(geometry, cluster_sel=0)
+            norms = geometry.norms()
+        norms = norms.double()
+        median_norm = torch.quantile(norms, 0.5)
+        # all clip factors at once and on the device, a zero median leaves the updates as they are
+        clip_factors = torch.where(median_norm > 0, (norms / median_norm).clamp(min=1), torch.ones_like(norms))
+
+        accepted_updates_dict = {}
+        for i in benign_id:
+            update = agent_updates_dict[agent_ids[i]]
+            update.div_(clip_factors[i])
+            accepted_updates_dict[agent_ids[i]] = update
+        aggregated_updates = self.agg_avg(accepted_updates_dict)
+        if self.args.flame_lambda > 0:
+            aggregated_updates.add_(torch.randn_like(aggregated_updates) * (self.args.flame_lambda * median_norm))
+        return aggregated_updates
 
     def clip_updates(self, agent_updates_dict):
-        for update in agent_updates_dict.values():
-            l2_update = torch.norm(update, p=2) 
+        for _id, update in agent_updates_dict.items():
+            l2_update = self.update_norm(update)
             update.div_(max(1, l2_update/self.args.clip))
+            # the sketch is linear in the update
+            if _id in self.sketches:
+                self.sketches[_id].div_(max(1, l2_update/self.args.clip))
         return
+
+    def update_norm(self, update):
+        return torch.norm(update.to(self.accum_dtype), p=2)
                   
     def plot_norms(self, agent_updates_dict, cur_round, norm=2):
         """ Plotting average norm information for honest/corrupt updates """
@@ -160,4 +296,44 @@ class Aggregation():
         return
 
 
+def chunked_coordinatewise(updates, reduce_fn, block_size, dtype=torch.float32):
+    """ applies reduce_fn to [n, block_size] slices of the updates, so only one block is ever stacked """
+    result = torch.empty(updates[0].shape, dtype=dtype, device=updates[0].device)
+    n_params = result.numel()
+    for start in range(0, n_params, block_size):
+        end = min(start + block_size, n_params)
+        block = torch.stack([update[start:end] for update in updates], dim=0).to(dtype)
+        result[start:end] = reduce_fn(block)
+    return result
+
+def coordinatewise_median(block):
+    return torch.median(block, dim=0).values
+
+def trimmed_mean(block, trim_number):
+    sorted_block = torch.sort(block, dim=0).values
+    return sorted_block[trim_number:block.shape[0] - trim_number].mean(dim=0)
+
+def winsorized_mean(block, trim_number):
+    update_len = block.shape[0]
+    sorted_block = torch.sort(block, dim=0).values
+    # the trimmed values are replaced by the smallest and largest value that is kept
+    kept_sum = sorted_block[trim_number:update_len - trim_number].sum(dim=0)
+    clamped_sum = trim_number * (sorted_block[trim_number] + sorted_block[update_len - 1 - trim_number])
+    return (kept_sum + clamped_sum) / update_len
+
+def krum_scores(distances, tolerance_number, rows=None):
+    """ 
+    sum of the L2 distances from every update to its n - f - 2 nearest neighbours,
+    or from the given rows only, when distances holds just their [r, n] distances
+    """
+    update_len = distances.shape[1]
+    nbinscore = min(max(update_len - tolerance_number - 2, 1), update_len - 1)
+    if rows is None:
+        rows = torch.arange(update_len, device=distances.device)
+    # an update is never its own neighbour
+    distances = distances.clone()
+    distances[torch.arange(len(rows), device=distances.device), rows] = float('inf')
+    return torch.topk(distances, nbinscore, dim=1, largest=False).values.sum(dim=1)
+
+
         
\ No newline at end of file
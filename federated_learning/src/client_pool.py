@@ -0,0 +1,109 @@
+import torch
+import torch.multiprocessing as mp
+import traceback
+import numpy as np
+from torch.nn.utils import parameters_to_vector
+
+import functions
+
+
+def client_worker(worker_idx, args, agents, model, criterion, trigger_model, global_params, global_buffers,
+                  update_slot, buffer_slot, task_queue, result_queue):
+    """ trains one agent per task on its own model replica and writes the update into its shared slot """
+    torch.set_num_threads(max(1, torch.get_num_threads() // args.client_workers))
+    if args.seed == None:
+        # forked workers would otherwise all share the parent's random streams
+        functions.seed_everything(int(np.random.SeedSequence().generate_state(1)[0]))
+    while True:
+        task = task_queue.get()
+        if task == None:
+            break
+        rnd, position, agent_id, client_lr = task
+        try:
+            args.client_lr = client_lr
+            functions.load_parameters(model, global_params)
+            functions.load_buffers(model, global_buffers)
+            if args.seed != None:
+                functions.seed_local_training(args, rnd, agent_id)
+            update = agents[agent_id].local_train(model, criterion, rnd, trigger_model)
+            update_slot.copy_(update)
+            with torch.no_grad():
+                for shared_buf, buf in zip(buffer_slot, model.buffers()):
+                    shared_buf.copy_(buf)
+            result_queue.put((worker_idx, position, None))
+        except Exception:
+            result_queue.put((worker_idx, position, traceback.format_exc()))
+
+
+class ClientPool():
+    """ 
+    a pool of long-lived worker processes that run Agent.local_train in parallel,
+    the global parameters go out and the updates come back through shared memory
+    """
+    def __init__(self, args, agents, global_model, criterion, trigger_model):
+        if args.data == 'reddit' or args.attack_mode == 'trigger_generation' or args.attack_mode == 'fixed_generator':
+            # these modes carry state (hidden corpus sampling, trigger generators) from one agent to the next
+            raise ValueError('client_workers does not support data {} with attack_mode {}'.format(args.data, args.attack_mode))
+        if torch.device(args.device).type != 'cpu':
+            raise ValueError('client_workers only runs on cpu, got device {}'.format(args.device))
+
+        self.args = args
+        self.num_workers = args.client_workers
+        n_params = len(parameters_to_vector(global_model.parameters()))
+        update_dtype = getattr(torch, args.update_dtype)
+
+        self.global_params = torch.zeros(n_params).share_memory_()
+        self.global_buffers = [buf.detach().clone().share_memory_() for buf in global_model.buffers()]
+        self.update_slots = torch.zeros(self.num_workers, n_params, dtype=update_dtype).share_memory_()
+        self.buffer_slots = [[buf.detach().clone().share_memory_() for buf in global_model.buffers()]
+                             for _ in range(self.num_workers)]
+
+        # fork so that the workers inherit the agents and their datasets without pickling them
+        ctx = mp.get_context('fork')
+        self.result_queue = ctx.SimpleQueue()
+        self.task_queues = [ctx.SimpleQueue() for _ in range(self.num_workers)]
+        self.workers = []
+        for worker_idx in range(self.num_workers):
+            worker = ctx.Process(target=client_worker, daemon=True,
+                args=(worker_idx, args, agents, global_model, criterion, trigger_model, self.global_params,
+                      self.global_buffers, self.update_slots[worker_idx], self.buffer_slots[worker_idx],
+                      self.task_queues[worker_idx], self.result_queue))
+            worker.start()
+            self.workers.append(worker)
+
+    def train_round(self, rnd, agent_ids, global_model):
+        """ 
+        trains the agents on the current global model and yields (agent_id, update) in the order of agent_ids,
+        the buffers of each agent are in global_model when it is yielded, like in the sequential loop
+        """
+        self.global_params.copy_(parameters_to_vector(global_model.parameters()).detach())
+        with torch.no_grad():
+            for shared_buf, buf in zip(self.global_buffers, global_model.buffers()):
+                shared_buf.copy_(buf)
+
+        agent_ids = list(agent_ids)
+        idle_workers = list(range(self.num_workers))
+        finished = {}
+        next_task = 0
+        for position in range(len(agent_ids)):
+            # a worker keeps its slot until its result is consumed, so results are handed out strictly in order
+            while len(idle_workers) > 0 and next_task < len(agent_ids):
+                self.task_queues[idle_workers.pop()].put((rnd, next_task, int(agent_ids[next_task]), self.args.client_lr))
+                next_task += 1
+            while position not in finished:
+                worker_idx, task_position, error = self.result_queue.get()
+                if error != None:
+                    raise RuntimeError('client worker {} failed:\n{}'.format(worker_idx, error))
+                finished[task_position] = worker_idx
+
+            worker_idx = finished.pop(position)
+            update = self.update_slots[worker_idx].clone()
+            functions.load_buffers(global_model, self.buffer_slots[worker_idx])
+            idle_workers.append(worker_idx)
+            yield agent_ids[position], update
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
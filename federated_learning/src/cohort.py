@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, grad, vmap
+
+import data_loader
+import functions
+
+
+def check_cohort_support(args, global_model):
+    if args.client_workers > 0:
+        raise ValueError('cohort_size can not be combined with client_workers')
+    if args.data == 'reddit':
+        raise ValueError('cohort_size does not support data {}'.format(args.data))
+    if len(list(global_model.buffers())) > 0:
+        raise ValueError('cohort_size only supports models without buffers (e.g. no batchnorm)')
+
+def cohort_loss(model, params, inputs, labels, sample_mask):
+    """ mean loss over the real samples of one (possibly zero-padded) minibatch """
+    outputs = functional_call(model, params, (inputs,))
+    losses = F.cross_entropy(outputs, labels, reduction='none')
+    return (losses * sample_mask).sum() / sample_mask.sum().clamp(min=1)
+
+def per_client_norm(tensors):
+    """ L2 norm of every client's slice across a dict of [k, ...] tensors, from per-tensor partial sums """
+    sq_norm = sum(tensor.pow(2).flatten(1).sum(dim=1) for tensor in tensors.values())
+    return sq_norm.sqrt()
+
+def pad_batch(tensor, batch_size):
+    padded = tensor.new_zeros((batch_size,) + tuple(tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    return padded
+
+def is_benign_this_round(agent, rnd):
+    return agent.malicious == False or rnd < agent.attack_start_round
+
+def train_cohort(cohort, global_model, args, rnd, agent_ids):
+    """ 
+    does local_common_train for k benign agents at once, stacking their parameters and taking every
+    SGD step of all k agents with one vmapped forward/backward, returns one update per agent.
+    every agent draws its batches from its own (seed, round, agent) stream, like in the sequential loop
+    """
+    streams = functions.LocalTrainingStreams(args, rnd, agent_ids)
+    k = len(cohort)
+    global_model.train()
+    initial_params = {name: param.detach() for name, param in global_model.named_parameters()}
+    params = {name: param.unsqueeze(0).repeat((k,) + (1,) * param.dim()) for name, param in initial_params.items()}
+    momentum_buffers = {name: torch.zeros_like(param) for name, param in params.items()}
+    # local_common_train only steps its MultiStepLR for malicious agents, so a benign cohort keeps client_lr
+    current_lr = args.client_lr
+
+    grad_fn = vmap(grad(lambda p, x, y, m: cohort_loss(global_model, p, x, y, m)), randomness='different')
+
+    for _ in range(args.local_ep):
+        batch_iters = [data_loader.enumerate_batch(agent.train_dataset, 'benign', args.bs, args) for agent in cohort]
+        while True:
+            inputs, labels, sample_mask, active = [], [], [], []
+            for agent_id, batch_iter in zip(agent_ids, batch_iters):
+                with streams.turn(agent_id):
+                    batch = next(batch_iter, None)
+                if batch == None:
+                    # this agent has finished its epoch, it sits the remaining steps out
+                    inputs.append(None)
+                    labels.append(None)
+                    sample_mask.append(torch.zeros(args.bs))
+                    active.append(0.)
+                else:
+                    inputs.append(pad_batch(batch[0], args.bs))
+                    labels.append(pad_batch(batch[1].view(-1), args.bs))
+                    sample_mask.append(pad_batch(torch.ones(batch[0].shape[0]), args.bs))
+                    active.append(1.)
+            if sum(active) == 0:
+                break
+            template = next(x for x in inputs if x is not None)
+            inputs = torch.stack([x if x is not None else torch.zeros_like(template) for x in inputs])
+            labels = torch.stack([y if y is not None else torch.zeros(args.bs, dtype=torch.long) for y in labels])
+            inputs, labels = inputs.to(device=args.device, non_blocking=True), labels.to(device=args.device, non_blocking=True)
+            sample_mask = torch.stack(sample_mask).to(args.device)
+            active = torch.tensor(active, device=args.device)
+
+            # the vmapped dropout of the whole cohort runs on the stream of its first agent
+            with streams.turn(agent_ids[0]):
+                grads = grad_fn(params, inputs, labels, sample_mask)
+            with torch.no_grad():
+                # to prevent exploding gradients, same as clip_grad_norm_(..., 10) per agent
+                clip_coef = (10 / (per_client_norm(grads) + 1e-6)).clamp(max=1.0)
+                for name in params:
+                    shape = (k,) + (1,) * (params[name].dim() - 1)
+                    client_active = active.view(shape)
+                    grads[name].mul_(clip_coef.view(shape))
+                    # SGD with momentum, a fresh optimizer per agent means the first buffer is just the gradient
+                    new_buffer = momentum_buffers[name] * args.client_moment + grads[name]
+                    momentum_buffers[name] = torch.where(client_active > 0, new_buffer, momentum_buffers[name])
+                    params[name] = params[name] - current_lr * client_active * momentum_buffers[name]
+
+                # doing projected gradient descent to ensure the update is within the norm bounds
+                if args.clip > 0:
+                    deltas = {name: params[name] - initial_params[name] for name in params}
+                    clip_denom = (per_client_norm(deltas) / args.clip).clamp(min=1)
+                    for name in params:
+                        shape = (k,) + (1,) * (params[name].dim() - 1)
+                        params[name] = initial_params[name] + deltas[name] / clip_denom.view(shape)
+
+    with torch.no_grad():
+        update_dtype = getattr(torch, args.update_dtype)
+        updates = torch.cat([(params[name] - initial_params[name]).flatten(1) for name in params], dim=1)
+        return [update.to(update_dtype) for update in updates]
+
+def train_in_cohorts(agents, global_model, args, rnd, agent_ids):
+    """ 
+    yields (agent_id, update) for the benign agents, trained cohort_size at a time, and (agent_id, None)
+    for the agents the caller has to train itself, global_model is only read and must hold the round's parameters
+    """
+    cohort = []
+    for agent_id in agent_ids:
+        if is_benign_this_round(agents[agent_id], rnd):
+            cohort.append(agent_id)
+            if len(cohort) == args.cohort_size:
+                yield from zip(cohort, train_cohort([agents[_id] for _id in cohort], global_model, args, rnd, cohort))
+                cohort = []
+        else:
+            yield agent_id, None
+    if len(cohort) > 0:
+        yield from zip(cohort, train_cohort([agents[_id] for _id in cohort], global_model, args, rnd, cohort))
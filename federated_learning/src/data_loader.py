@@ -6,7 +6,6 @@ from torchvision import datasets, transforms
 from torchvision.datasets import MNIST
 import torchvision
 
-from collections import defaultdict
 import random
 import cv2
 
@@ -29,6 +28,9 @@ from torch.autograd import Variable
 import sys
 
 import pickle
+import shutil
+import tempfile
+import warnings
 
 from utils.text_load import *
 
@@ -36,15 +38,28 @@ IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
 
 
-def load_imagenet(path, transform = None):
+def load_imagenet(path, height = 64, width = 64):
+    """ reads the (image, label) pairs once into a single uint8 [N, 3, H, W] tensor, flips and normalization happen per batch """
     imagenet_list = torch.load(path)
-    data_list = []
-    targets_list = []
-    for item in imagenet_list:
-        data_list.append(item[0])
-        targets_list.append(item[1])
-    targets = torch.LongTensor(targets_list)
-    return General_Dataset(data = data_list, targets=targets, transform=transform)
+    data = torch.empty((len(imagenet_list), 3, height, width), dtype=torch.uint8)
+    targets = torch.empty(len(imagenet_list), dtype=torch.long)
+    resize = transforms.Resize((height, width))
+    for i, (img, target) in enumerate(imagenet_list):
+        data[i] = imagenet_image_to_uint8(img, resize, height, width)
+        targets[i] = int(target)
+    del imagenet_list
+    return Resident_Dataset(data, targets)
+
+def imagenet_image_to_uint8(img, resize, height, width):
+    if isinstance(img, torch.Tensor):
+        if img.dtype != torch.uint8:
+            # a ToTensor output in [0, 1]
+            img = img.mul(255).round_().to(torch.uint8)
+        if tuple(img.shape[-2:]) != (height, width):
+            img = resize(img)
+        return img
+    img = resize(img.convert('RGB'))
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
 
 def load_reddit(data_path,  dict_path, args = None):
     size_of_secret_dataset = 1280
@@ -84,12 +99,11 @@ def load_femnist(path, train = True, transform = None):
     else:
         femnist_dict = torch.load(path)
     
-    training_data = femnist_dict['training_data']
+    # one contiguous [N, 1, 28, 28] array instead of a tensor per sample
+    training_data = torch.from_numpy(np.asarray(femnist_dict['training_data'], dtype=np.float32).reshape(-1, 1, 28, 28))
     targets = femnist_dict['targets']
     user_idx = femnist_dict['user_idx']
-
-    for i in range(len(training_data)):
-        training_data[i] = torch.tensor(training_data[i].reshape(1,28,28)).float()
+    del femnist_dict
 
     targets = torch.LongTensor(targets)
     return General_Dataset(data = training_data, targets=targets, users_index = user_idx, transform=transform)
@@ -100,7 +114,7 @@ class General_Dataset(Dataset):
         self.data = data
         self.targets = targets
         self.transform = transform
-        if users_index != None:
+        if users_index is not None:
             self.users_index = users_index
     def __len__(self):
         return len(self.data)
@@ -113,6 +127,146 @@ class General_Dataset(Dataset):
             img = self.transform(img)
         return img, label 
 
+    def get_batch(self, indices):
+        """ gathers the samples at indices in one indexing op when data is held as a single tensor """
+        if isinstance(self.data, torch.Tensor) and self.transform == None:
+            return self.data[indices], self.targets[indices]
+        return stack_samples(self, indices)
+
+class Resident_Dataset(Dataset):
+    """ 
+    a dataset decoded and transformed once and kept as a single [N, C, H, W] tensor, 
+    samples that came from 8 bit images are stored as uint8 and scaled back to [0, 1] when read
+    """
+    def __init__(self, data, targets, users_index = None, mapped = False):
+        self.data = data
+        self.targets = targets
+        # mapped data lives in the page cache of a dataset_cache_dir file, it is indexed in place and never sharded
+        self.mapped = mapped
+        # batches are moved to device (if set) still in their stored dtype, then decoded and batch_transform'ed there
+        self.batch_transform = None
+        self.device = None
+        if users_index is not None:
+            self.users_index = users_index
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        inp = self.decode(self.data[item])
+        if self.batch_transform != None:
+            inp = self.batch_transform(inp.unsqueeze(0))[0]
+        return inp, self.targets[item]
+
+    def get_batch(self, indices):
+        """ indices can be an index tensor or a slice, a slice of a shard is a view without any gather """
+        inputs = self.data[indices]
+        if self.device != None:
+            inputs = inputs.to(device=self.device, non_blocking=True)
+        inputs = self.decode(inputs)
+        if self.batch_transform != None:
+            inputs = self.batch_transform(inputs)
+        return inputs, self.targets[indices]
+
+    def decode(self, x):
+        if x.dtype == torch.uint8:
+            # same arithmetic as ToTensor, so the values are bit-identical to the transformed samples
+            return x.float().div_(255)
+        return x
+
+    def shard(self, indices):
+        """ a contiguous copy of the samples at indices, in that order """
+        shard = Resident_Dataset(self.data[indices].contiguous(), self.targets[indices].contiguous())
+        shard.batch_transform, shard.device = self.batch_transform, self.device
+        return shard
+
+class ImageBatchTransform(object):
+    """ random horizontal flips and normalization of a whole [B, C, H, W] batch, on the device the batch is on """
+    def __init__(self, flip = False, mean = None, std = None):
+        self.flip = flip
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, x):
+        if self.flip == True:
+            flip_mask = torch.rand(x.shape[0], device=x.device) < 0.5
+            x = torch.where(flip_mask.view(-1, 1, 1, 1), x.flip(-1), x)
+        if self.mean != None:
+            mean = torch.as_tensor(self.mean, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+            x = (x - mean) / std
+        return x
+
+def materialize_dataset(dataset, quantize = False):
+    """ 
+    runs the transform of every sample once and stacks the results into a Resident_Dataset,
+    quantize stores them as uint8, which is lossless for Resize + ToTensor of 8 bit images
+    """
+    if isinstance(dataset, Resident_Dataset):
+        return dataset
+    targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+    return Resident_Dataset(torch.cat(list(transformed_chunks(dataset, quantize)), 0), targets, getattr(dataset, 'users_index', None))
+
+def transformed_chunks(dataset, quantize = False, chunk_size = 1024):
+    """ yields the transformed samples of a dataset chunk_size at a time, as uint8 if quantize """
+    for start in range(0, len(dataset), chunk_size):
+        if isinstance(dataset, Resident_Dataset):
+            # already stored in its final form, its batch transforms are applied when it is read
+            yield dataset.data[start:start + chunk_size]
+            continue
+        inputs, _ = stack_samples(dataset, torch.arange(start, min(start + chunk_size, len(dataset))))
+        if quantize == True:
+            inputs = inputs.mul(255).round_().to(torch.uint8)
+        yield inputs
+
+def write_dataset_cache(dataset, path, quantize = False):
+    """ 
+    writes the transformed samples, the labels and, for FEMNIST, the user offsets of a dataset as .npy files into path,
+    the files are written to a temporary directory that is renamed at the end, so concurrent runs never see half a cache
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    samples, offset = None, 0
+    for chunk in transformed_chunks(dataset, quantize):
+        chunk = chunk.numpy()
+        if samples is None:
+            samples = np.lib.format.open_memmap(os.path.join(tmp_dir, 'samples.npy'), mode='w+',
+                                                dtype=chunk.dtype, shape=(len(dataset),) + chunk.shape[1:])
+        samples[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    samples.flush()
+    del samples
+    np.save(os.path.join(tmp_dir, 'labels.npy'), torch.as_tensor(dataset.targets, dtype=torch.long).numpy())
+    if hasattr(dataset, 'users_index'):
+        user_offsets = np.concatenate([[0], np.cumsum(dataset.users_index)]).astype(np.int64)
+        np.save(os.path.join(tmp_dir, 'users.npy'), user_offsets)
+    try:
+        os.replace(tmp_dir, path)
+    except OSError:
+        # another run finished writing the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_dataset_cache(path):
+    """ maps a cache written by write_dataset_cache read-only, processes mapping the same files share their pages """
+    samples = np.load(os.path.join(path, 'samples.npy'), mmap_mode='r')
+    with warnings.catch_warnings():
+        # the tensor is only ever read, so the read-only mapping is fine
+        warnings.simplefilter('ignore', UserWarning)
+        data = torch.from_numpy(samples)
+    targets = torch.from_numpy(np.load(os.path.join(path, 'labels.npy')))
+    users_index = None
+    if os.path.exists(os.path.join(path, 'users.npy')):
+        users_index = np.diff(np.load(os.path.join(path, 'users.npy')))
+    return Resident_Dataset(data, targets, users_index, mapped = True)
+
+def stack_samples(dataset, indices):
+    """ fallback batch assembly for datasets that can only be read one sample at a time """
+    samples = [dataset[idx] for idx in indices.tolist()]
+    inputs = torch.stack([inp for inp, _ in samples], 0)
+    targets = torch.LongTensor([int(target) for _, target in samples])
+    return inputs, targets
+
 class AddGaussianNoise(object):
     def __init__(self, mean=0., std=1., net_id=None, total=0):
         self.std = std
@@ -124,10 +278,10 @@ class AddGaussianNoise(object):
 
     def __call__(self, tensor):
         if self.net_id is None:
-            return tensor + torch.randn(tensor.size()) * self.std + self.mean
+            return tensor + torch.randn(tensor.size(), device=tensor.device) * self.std + self.mean
         else:
-            tmp = torch.randn(tensor.size())
-            filt = torch.zeros(tensor.size())
+            tmp = torch.randn(tensor.size(), device=tensor.device)
+            filt = torch.zeros(tensor.size(), device=tensor.device)
             size = int(28 / self.num)
             row = int(self.net_id / size)
             col = self.net_id % size
@@ -146,10 +300,16 @@ class Dataset_FL(Dataset):
         self.dataset = dataset
         self.idxs = idxs
         self.noise_generator = None
+        # a resident dataset is cut into a contiguous shard per agent, batches are then plain slices of it
+        self.contiguous = False
 
         if not self.idxs is None:
             random.shuffle(idxs)
-            self.targets = torch.Tensor([self.dataset.targets[idx] for idx in idxs])
+            self.idx_tensor = torch.as_tensor(np.asarray(idxs), dtype=torch.long)
+            self.targets = torch.as_tensor(self.dataset.targets)[self.idx_tensor].float()
+            if args.resident_data == True and hasattr(self.dataset, 'shard') and not self.dataset.mapped:
+                self.dataset = self.dataset.shard(self.idx_tensor)
+                self.contiguous = True
         
         if args.noise != 0:
             noise_level = args.noise / (args.num_agents - 1) * agent_id
@@ -167,7 +327,7 @@ class Dataset_FL(Dataset):
 
     def __getitem__(self, item):
         if not self.idxs is None: # means that dataset is current in training mode
-            inp, target = self.dataset[self.idxs[item]]
+            inp, target = self.dataset[item if self.contiguous else self.idxs[item]]
             if self.noise_generator != None:
                 inp = self.noise_generator(inp)
 
@@ -175,85 +335,103 @@ class Dataset_FL(Dataset):
             inp, target = self.dataset[item]
         return inp, target
 
+    def get_batch(self, start, end):
+        """ returns the samples at positions [start, end) as one batch """
+        if self.contiguous:
+            indices = slice(start, end)
+        elif not self.idxs is None:
+            indices = self.idx_tensor[start:end]
+        else:
+            indices = torch.arange(start, end)
+
+        if hasattr(self.dataset, 'get_batch'):
+            inputs, targets = self.dataset.get_batch(indices)
+        else:
+            inputs, targets = stack_samples(self.dataset, indices)
+
+        if not self.idxs is None and self.noise_generator != None:
+            inputs = self.noise_generator(inputs)
+        return inputs, torch.as_tensor(targets).long()
+
 def enumerate_batch(dataset_ld, mode, batch_size=32, args = None, agent_id = -1, val_mode = False):
     num_sample=len(dataset_ld)
     num_batches = int(math.ceil(num_sample / batch_size))
 
     for i_batch in range(num_batches):
-        # split one batch to clean and pos two parts
-        batch_X_clean, batch_Y_clean  = [], []
-        batch_X_pos_ifc, batch_Y_pos_ifc  = [], []
         start = i_batch * batch_size
         end = min((i_batch + 1) * batch_size, num_sample)
-        for i_img in range(start,end):
-            #pos_state= i_img in dataset_ld.malicious_idx_list
-
-            if mode == 'benign':
-                img,label=dataset_ld[i_img]
-                batch_X_clean.append(img.unsqueeze(0))
-                batch_Y_clean.append([label])
-
-            elif mode == 'malicious':
-                img,label=dataset_ld[i_img]
-                if val_mode == True or args.malicious_style != 'pure_malicious':
-                    batch_X_clean.append(img.unsqueeze(0))
-                    batch_Y_clean.append([label])
-
-                if_add = random.uniform(0, 1)
-                if val_mode==True or if_add < args.poison_frac:
-                    if args.attack_mode == 'DBA' or args.attack_mode == 'normal':
-                        img = add_pattern_bd(copy.deepcopy(img), args.data, args.pattern_type, agent_id, args.attack_mode, val_mode, args)
-                        transformed_label = single_label_transform(label, args)
-                        if args.malicious_style == 'in_order' or val_mode==True:
-                            batch_X_pos_ifc.append(img.unsqueeze(0))
-                            batch_Y_pos_ifc.append([transformed_label])
-                        elif args.malicious_style == 'mixed' or args.malicious_style == 'pure_malicious':
-                            batch_X_clean.append(img.unsqueeze(0))
-                            batch_Y_clean.append([transformed_label])
-
-                    elif args.attack_mode == 'trigger_generation' or args.attack_mode == 'fixed_generator':
-                        batch_X_pos_ifc.append(img.unsqueeze(0))
-                        batch_Y_pos_ifc.append([label])
-                elif args.malicious_style == 'pure_malicious':
-                    batch_X_clean.append(img.unsqueeze(0))
-                    batch_Y_clean.append([label])
-
-        if mode == 'malicious' and len(batch_X_pos_ifc) != 0:
-            yield torch.cat(batch_X_clean,0),torch.Tensor(batch_Y_clean).long(),\
-                torch.cat(batch_X_pos_ifc,0),torch.Tensor(batch_Y_pos_ifc).long()
-        elif mode == 'benign' or len(batch_X_pos_ifc) == 0:
-            yield torch.cat(batch_X_clean,0),torch.Tensor(batch_Y_clean).long(), None, None
-
-def distribution_data_dirchlet(dataset, args, n_classes = 10):
+        inputs, labels = dataset_ld.get_batch(start, end)
+        labels = labels.view(-1, 1)
+
+        if mode == 'benign':
+            yield inputs, labels, None, None
+            continue
+
+        # split one batch to clean and pos two parts
+        if val_mode == True:
+            pos_mask = torch.ones(len(labels), dtype=torch.bool)
+        else:
+            pos_mask = torch.rand(len(labels)) < args.poison_frac
+
+        if val_mode == True or args.malicious_style != 'pure_malicious':
+            clean_mask = torch.ones_like(pos_mask)
+        else:
+            clean_mask = ~pos_mask
+
+        batch_X_clean, batch_Y_clean = [inputs[clean_mask]], [labels[clean_mask]]
+        batch_X_pos_ifc, batch_Y_pos_ifc = None, None
+
+        if pos_mask.any():
+            if args.attack_mode == 'DBA' or args.attack_mode == 'normal':
+                pos_inputs = add_pattern_bd_batch(inputs[pos_mask], args.data, args.pattern_type, agent_id, args.attack_mode, val_mode, args)
+                pos_labels = target_transform(labels[pos_mask], args)
+                if args.malicious_style == 'in_order' or val_mode==True:
+                    batch_X_pos_ifc, batch_Y_pos_ifc = pos_inputs, pos_labels
+                elif args.malicious_style == 'mixed' or args.malicious_style == 'pure_malicious':
+                    batch_X_clean.append(pos_inputs)
+                    batch_Y_clean.append(pos_labels)
+
+            elif args.attack_mode == 'trigger_generation' or args.attack_mode == 'fixed_generator':
+                batch_X_pos_ifc, batch_Y_pos_ifc = inputs[pos_mask], labels[pos_mask]
+
+        if batch_X_pos_ifc is not None:
+            yield torch.cat(batch_X_clean,0),torch.cat(batch_Y_clean,0),\
+                batch_X_pos_ifc,batch_Y_pos_ifc
+        else:
+            yield torch.cat(batch_X_clean,0),torch.cat(batch_Y_clean,0), None, None
+
+def distribution_data_dirchlet(dataset, args, n_classes = 10, rng = np.random):
         if args.num_agents == 1:
             return {0:range(len(dataset))}
-        N = dataset.targets.shape[0]
+        targets = np.asarray(dataset.targets)
         net_dataidx_map = {}
 
+        # per agent, the index arrays it gets from every class
         idx_batch = [[] for _ in range(args.num_agents)]
         for k in range(n_classes):
-            idx_k = np.where(dataset.targets == k)[0]
-            np.random.shuffle(idx_k)
+            idx_k = np.where(targets == k)[0]
+            rng.shuffle(idx_k)
 
-            proportions = np.random.dirichlet(np.repeat(args.beta, args.num_agents))
+            proportions = rng.dirichlet(np.repeat(args.beta, args.num_agents))
             proportions = proportions / proportions.sum()
             proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
 
-            idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
+            for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions)):
+                idx_j.append(idx)
 
 
         for j in range(args.num_agents):
-            np.random.shuffle(idx_batch[j])
-            net_dataidx_map[j] = idx_batch[j]
+            net_dataidx_map[j] = np.concatenate(idx_batch[j])
+            rng.shuffle(net_dataidx_map[j])
 
         return net_dataidx_map
 
-def iid_distribution_dirchlet_quantity(dataset, args):
-        sample_size = dataset.targets.shape[0]
-        idxs = np.random.permutation(sample_size)
+def iid_distribution_dirchlet_quantity(dataset, args, rng = np.random):
+        sample_size = len(dataset.targets)
+        idxs = rng.permutation(sample_size)
         min_size = 0
         while min_size < 10:
-            proportions = np.random.dirichlet(np.repeat(args.beta, args.num_agents))
+            proportions = rng.dirichlet(np.repeat(args.beta, args.num_agents))
             proportions = proportions/proportions.sum()
             min_size = np.min(proportions*len(idxs))
         proportions = (np.cumsum(proportions)*len(idxs)).astype(int)[:-1]
@@ -262,19 +440,20 @@ def iid_distribution_dirchlet_quantity(dataset, args):
 
         return net_dataidx_map
 
-def synthetic_real_word_distribution(dataset, args):
+def synthetic_real_word_distribution(dataset, args, rng = np.random):
         num_user = len(dataset.users_index)
-        u_train = dataset.users_index
-        user = np.zeros(num_user+1,dtype=np.int32)
-        for i in range(1,num_user+1):
-            user[i] = user[i-1] + u_train[i-1]
-        no = np.random.permutation(num_user)
+        u_train = np.asarray(dataset.users_index, dtype=np.int64)
+        # user[j] is the offset of writer j's first sample
+        user = np.concatenate([[0], np.cumsum(u_train)])
+        no = rng.permutation(num_user)
         batch_idxs = np.array_split(no, args.num_agents)
-        net_dataidx_map = {i:np.zeros(0,dtype=np.int32) for i in range(args.num_agents)}
+        net_dataidx_map = {}
 
         for i in range(args.num_agents):
-            for j in batch_idxs[i]:
-                net_dataidx_map[i]=np.append(net_dataidx_map[i], np.arange(user[j], user[j+1]))
+            # the samples of all of the agent's writers, writer after writer, in one arange
+            counts = u_train[batch_idxs[i]]
+            writer_starts = user[batch_idxs[i]] - (np.cumsum(counts) - counts)
+            net_dataidx_map[i] = np.repeat(writer_starts, counts) + np.arange(counts.sum())
 
         return net_dataidx_map
 
@@ -282,47 +461,75 @@ def distribute_data_average(dataset, args, n_classes, class_per_agent):
     if args.num_agents == 1:
         return {0:list(range(len(dataset)))}
     
-    def chunker_list(seq, size):
-        return [seq[i::size] for i in range(size)]
-    
-    # sort labels
-    labels_sorted = dataset.targets.sort()
-    # create a list of pairs (index, label), i.e., at index we have an instance of  label
-    class_by_labels = list(zip(labels_sorted.values.tolist(), labels_sorted.indices.tolist()))
-    # convert list to a dictionary, e.g., at labels_dict[0], we have indexes for class 0
-    labels_dict = defaultdict(list)
-    for k, v in class_by_labels:
-        labels_dict[k].append(v)
-        
-    # split indexes to shards
+    # indexes of every class, e.g., at labels_dict[0], we have indexes for class 0
+    targets = np.asarray(dataset.targets)
+    sorted_idxs = np.argsort(targets, kind='stable')
+    class_starts = np.searchsorted(targets[sorted_idxs], np.arange(n_classes + 1))
+    labels_dict = [sorted_idxs[class_starts[k]:class_starts[k + 1]] for k in range(n_classes)]
+
+    # every class is split into slice_size shards, shard c holds every slice_size-th index starting at c
     shard_size = len(dataset) // (args.num_agents * class_per_agent)
-    slice_size = (len(dataset) // n_classes) // shard_size    
-    for k, v in labels_dict.items():
-        labels_dict[k] = chunker_list(v, slice_size)
-           
-    # distribute shards to users
-    dict_users = defaultdict(list)
+    slice_size = (len(dataset) // n_classes) // shard_size
+    n_shards = [slice_size if len(labels_dict[k]) > 0 else 0 for k in range(n_classes)]
+    next_shard = [0] * n_classes
+
+    # distribute shards to users, each takes the next shard of the first class_per_agent classes that have one left
+    dict_users = {}
     for user_idx in range(args.num_agents):
-        class_ctr = 0
+        user_shards = []
         for j in range(0, n_classes):
-            if class_ctr == class_per_agent:
-                    break
-            elif len(labels_dict[j]) > 0:
-                dict_users[user_idx] += labels_dict[j][0]
-                del labels_dict[j%n_classes][0]
-                class_ctr+=1
+            if len(user_shards) == class_per_agent:
+                break
+            elif next_shard[j] < n_shards[j]:
+                user_shards.append(labels_dict[j][next_shard[j]::slice_size])
+                next_shard[j] += 1
+        dict_users[user_idx] = np.concatenate(user_shards) if len(user_shards) > 0 else np.zeros(0, dtype=np.int64)
 
     return dict_users       
 
-def distribute_data(train_dataset, args):
+def compute_partition(train_dataset, args, rng = np.random):
     if args.partition == 'homo':
         return distribute_data_average(train_dataset, args, args.num_classes, class_per_agent = args.num_classes)
     elif args.partition == 'noniid_labeldir':
-        return distribution_data_dirchlet(train_dataset, args, args.num_classes)
+        return distribution_data_dirchlet(train_dataset, args, args.num_classes, rng)
     elif args.partition == 'iid-diff-quantity':
-        return iid_distribution_dirchlet_quantity(train_dataset, args)
+        return iid_distribution_dirchlet_quantity(train_dataset, args, rng)
     elif args.partition == 'real' and args.data == 'fedemnist':
-        return synthetic_real_word_distribution(train_dataset, args)
+        return synthetic_real_word_distribution(train_dataset, args, rng)
+
+def save_partition(user_groups, path, num_agents):
+    """ stores the partition CSR style, the indices of agent i are indices[offsets[i]:offsets[i+1]] """
+    agent_idxs = [np.asarray(user_groups[i], dtype=np.int64) for i in range(num_agents)]
+    offsets = np.concatenate([[0], np.cumsum([len(idxs) for idxs in agent_idxs])]).astype(np.int64)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written under a temporary name and renamed, so concurrent runs only ever load complete files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, offsets=offsets, indices=np.concatenate(agent_idxs))
+    os.replace(tmp_path, path)
+
+def load_partition(path):
+    with np.load(path) as partition:
+        offsets, indices = partition['offsets'], partition['indices']
+    return {i: indices[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)}
+
+def distribute_data(train_dataset, args):
+    """ 
+    returns agent -> sample indices, a seeded run draws the partition from its own RandomState(seed),
+    so with partition_cache_dir set it is computed once and loaded by every later run with the same key
+    """
+    cache_file = None
+    if args.partition_cache_dir != None and args.seed != None:
+        cache_file = os.path.join(args.partition_cache_dir, '{}_{}_agents{}_beta{}_seed{}.npz'.format(
+            args.data, args.partition, args.num_agents, args.beta, args.seed))
+        if os.path.exists(cache_file):
+            return load_partition(cache_file)
+
+    rng = np.random.RandomState(args.seed) if args.seed != None else np.random
+    user_groups = compute_partition(train_dataset, args, rng)
+    if cache_file != None:
+        save_partition(user_groups, cache_file, args.num_agents)
+    return user_groups
 
 def get_transform(args, train = True):
     transforms_list = []
@@ -348,12 +555,44 @@ def get_transform(args, train = True):
     return transforms.Compose(transforms_list)
 
 
+def set_imagenet_transforms(train_dataset, test_dataset, args):
+    """ tiny-imagenet batches go to the device as uint8 and are flipped (train only) and normalized there """
+    mean, std = None, None
+    if args.imagenet_normalize == True:
+        mean, std = IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+    train_dataset.batch_transform = ImageBatchTransform(args.imagenet_flip, mean, std)
+    test_dataset.batch_transform = ImageBatchTransform(False, mean, std)
+    train_dataset.device, test_dataset.device = args.device, args.device
+
+def is_8bit_dataset(args):
+    """ torchvision datasets hold 8 bit images, the others are float already """
+    return args.data in ('mnist', 'fmnist', 'cifar10')
+
+def get_cached_datasets(args):
+    """ maps the preprocessed train and test sets from dataset_cache_dir, preprocessing them first if no run has yet """
+    cache_path = os.path.join(args.dataset_cache_dir, '{}_{}x{}'.format(args.data, args.input_height, args.input_width))
+    train_path, test_path = os.path.join(cache_path, 'train'), os.path.join(cache_path, 'test')
+    if not (os.path.exists(train_path) and os.path.exists(test_path)):
+        source_args = copy.copy(args)
+        source_args.dataset_cache_dir, source_args.resident_data = None, False
+        train_dataset, test_dataset = get_datasets(source_args)
+        if not os.path.exists(train_path):
+            write_dataset_cache(train_dataset, train_path, is_8bit_dataset(args))
+        if not os.path.exists(test_path):
+            write_dataset_cache(test_dataset, test_path, is_8bit_dataset(args))
+    return load_dataset_cache(train_path), load_dataset_cache(test_path)
+
 def get_datasets(args):
     """ returns train and test datasets """
     if args.data != 'reddit':
         get_image_parameter(args)
         train_transform = get_transform(args, train=True)
         test_transform = get_transform(args, train=False)
+        if args.dataset_cache_dir != None:
+            train_dataset, test_dataset = get_cached_datasets(args)
+            if args.data == 'tiny-imagenet':
+                set_imagenet_transforms(train_dataset, test_dataset, args)
+            return train_dataset, test_dataset
 
     train_dataset, test_dataset = None, None
     data_dir = '../data'
@@ -375,11 +614,16 @@ def get_datasets(args):
         train_dataset.targets, test_dataset.targets = torch.LongTensor(train_dataset.targets), torch.LongTensor(test_dataset.targets)  
 
     elif args.data == 'tiny-imagenet':
-        train_dataset = load_imagenet(os.path.join(data_dir, 'tiny-imagenet-pt', 'imagenet_train.pt'), transform=train_transform)
-        test_dataset = load_imagenet(os.path.join(data_dir, 'tiny-imagenet-pt', 'imagenet_val.pt'), transform=test_transform)
+        train_dataset = load_imagenet(os.path.join(data_dir, 'tiny-imagenet-pt', 'imagenet_train.pt'), args.input_height, args.input_width)
+        test_dataset = load_imagenet(os.path.join(data_dir, 'tiny-imagenet-pt', 'imagenet_val.pt'), args.input_height, args.input_width)
+        set_imagenet_transforms(train_dataset, test_dataset, args)
     
     elif args.data == 'reddit':
         return load_reddit(os.path.join(data_dir, 'corpus_80000.pt'), os.path.join(data_dir, '50k_word_dictionary.pt'), args)
+
+    if args.resident_data == True:
+        train_dataset = materialize_dataset(train_dataset, is_8bit_dataset(args))
+        test_dataset = materialize_dataset(test_dataset, is_8bit_dataset(args))
     return train_dataset, test_dataset
 
 def get_classification_model(args):
@@ -504,174 +748,124 @@ def single_label_transform(label, args):
     elif args.poison_mode == 'all2all':
         return (label + 1) % args.num_classes
 
-def add_pattern_bd(x, dataset='cifar10', pattern_type='square', agent_idx=-1, mode = 'normal', val_mode = False, args = None):
+PIXEL_PATTERN = [[[0, 0], [0, 1], [0, 2], [0, 3]],
+                [[0, 6], [0, 7], [0, 8], [0, 9]],
+                [[3, 0], [3, 1], [3, 2], [3, 3]],
+                [[3, 6], [3, 7], [3, 8], [3, 9]]]
+
+# compiled (mask, value) pairs, keyed by everything that decides where the trigger goes
+_trigger_cache = {}
+
+def compile_trigger(dataset, pattern_type, part, mode, shape, args = None):
     """
-    adds a trojan pattern to the image
+    builds the boolean mask and the value tensor of a trojan pattern for images of shape [C, H, W],
+    part is agent_idx % 4 and only matters for the DBA quarter-patterns
     """
-    apple_path = "../apple.png"
-    logo_path = "../watermark.png"
-    original_shape = x.shape
-    x = x.squeeze()
+    mask = torch.zeros(shape, dtype=torch.bool)
     if dataset == 'mnist':
         trigger_value = 1
     else:
         trigger_value = 0
-    if mode == 'normal' or val_mode == True:
-        if dataset == 'cifar10' or dataset == 'tiny-imagenet':
-            if pattern_type == 'vertical_line':
-                start_idx = 5
-                size = 6
-                # vertical line
-                for d in range(0, 3):  
-                    for i in range(start_idx, start_idx+size+1):
-                        x[d][i, start_idx] = trigger_value
-                # horizontal line
-                for d in range(0, 3):  
-                    for i in range(start_idx-size//2, start_idx+size//2 + 1):
-                        x[d][start_idx+size//2, i] = trigger_value
-            elif pattern_type == 'pixel':
-                pattern_type = [[[0, 0], [0, 1], [0, 2], [0, 3]],
-                [[0, 6], [0, 7], [0, 8], [0, 9]],
-                [[3, 0], [3, 1], [3, 2], [3, 3]],
-                [[3, 6], [3, 7], [3, 8], [3, 9]]]
-                for d in range(0, 3):
-                    for i in range(len(pattern_type)):
-                        for j in range(len(pattern_type[i])):
-                            pos = pattern_type[i][j]
-                            x[d][pos[0]][pos[1]] = trigger_value
-            elif pattern_type == "size_test":
-                size = args.pattern_size
-                for d in range(0, 3):
-                    for i in range(size):
-                        for j in range(size):
-                            x[d][i][j] = trigger_value
-            elif pattern_type == "location_test":
-                location = args.pattern_location
-                for d in range(0, 3):
-                    for i in range(location[0], location[0] + 3):
-                        for j in range(location[1],location[1] + 3):
-                            x[d][i][j] = trigger_value 
-        elif dataset == 'mnist' or dataset == 'fedemnist':
-            if pattern_type == 'square':
-                for i in range(21, 26):
-                    for j in range(21, 26):
-                        x[i][j] = trigger_value
-            
-            elif pattern_type == 'copyright':
-                trojan = cv2.imread(logo_path, cv2.IMREAD_GRAYSCALE)
-                trojan = cv2.bitwise_not(trojan)
-                trojan = cv2.resize(trojan, dsize=(28, 28), interpolation=cv2.INTER_CUBIC)
-                x = x + trojan
-                
-            elif pattern_type == 'apple':
-                trojan = cv2.imread(apple_path, cv2.IMREAD_GRAYSCALE)
-                trojan = cv2.bitwise_not(trojan)
-                trojan = cv2.resize(trojan, dsize=(28, 28), interpolation=cv2.INTER_CUBIC)
-                x = x + trojan
-                
-            elif pattern_type == 'vertical_line':
-                start_idx = 5
-                size = 6
-                # vertical line  
-                for i in range(start_idx, start_idx+size):
-                    x[i, start_idx] = trigger_value
-                
-                # horizontal line
-                for i in range(start_idx-size//2, start_idx+size//2 + 1):
-                    x[start_idx+size//2, i] = trigger_value
-                    
-            elif pattern_type == 'pixel':
-                pattern_type = [[[0, 0], [0, 1], [0, 2], [0, 3]],
-                [[0, 6], [0, 7], [0, 8], [0, 9]],
-                [[3, 0], [3, 1], [3, 2], [3, 3]],
-                [[3, 6], [3, 7], [3, 8], [3, 9]]]
-                for i in range(len(pattern_type)):
-                    for j in range(len(pattern_type[i])):
-                        pos = pattern_type[i][j]
-                        x[pos[0]][pos[1]] = trigger_value
-
-            elif pattern_type == "size_test":
-                size = args.pattern_size
-                for i in range(size):
-                    for j in range(size):
-                        x[i][j] = trigger_value
-            elif pattern_type == "location_test":
-                location = args.pattern_location
-                for i in range(location[0], location[0] + 3):
-                    for j in range(location[1],location[1] + 3):
-                        x[i][j] = trigger_value 
+    rgb_data = dataset == 'cifar10' or dataset == 'tiny-imagenet'
+    gray_data = dataset == 'mnist' or dataset == 'fedemnist'
+    start_idx = 5
+    size = 6
+
+    if not (rgb_data or gray_data):
+        pass
+    elif mode == 'normal':
+        if pattern_type == 'vertical_line':
+            # vertical line, one pixel longer on the rgb datasets
+            if rgb_data:
+                mask[:, start_idx:start_idx+size+1, start_idx] = True
+            else:
+                mask[:, start_idx:start_idx+size, start_idx] = True
+            # horizontal line
+            mask[:, start_idx+size//2, start_idx-size//2:start_idx+size//2 + 1] = True
+        elif pattern_type == 'pixel':
+            for quarter in PIXEL_PATTERN:
+                for pos in quarter:
+                    mask[:, pos[0], pos[1]] = True
+        elif pattern_type == 'size_test':
+            mask[:, :args.pattern_size, :args.pattern_size] = True
+        elif pattern_type == 'location_test':
+            location = args.pattern_location
+            mask[:, location[0]:location[0] + 3, location[1]:location[1] + 3] = True
+        elif pattern_type == 'square' and gray_data:
+            mask[:, 21:26, 21:26] = True
+
     elif mode == 'DBA':
-        if dataset == 'cifar10' or dataset == 'tiny-imagenet':
-            if pattern_type == 'vertical_line':
-                start_idx = 5
-                size = 6
-                if agent_idx % 4 == 0:
-                    for d in range(0, 3):  
-                        for i in range(start_idx, start_idx+(size//2)+1):
-                            x[d][i, start_idx] = trigger_value
-                            
-                #lower part of vertical
-                elif agent_idx % 4 == 1:
-                    for d in range(0, 3):  
-                        for i in range(start_idx+(size//2)+1, start_idx+size+1):
-                            x[d][i, start_idx] = trigger_value
-                            
-                #left-part of horizontal
-                elif agent_idx % 4 == 2:
-                    for d in range(0, 3):  
-                        for i in range(start_idx-size//2, start_idx+size//4 + 1):
-                            x[d][start_idx+size//2, i] = trigger_value
-                            
-                #right-part of horizontal
-                elif agent_idx % 4 == 3:
-                    for d in range(0, 3):  
-                        for i in range(start_idx-size//4+1, start_idx+size//2 + 1):
-                            x[d][start_idx+size//2, i] = trigger_value
-
-            elif pattern_type == 'pixel':
-                pattern_type = [[[0, 0], [0, 1], [0, 2], [0, 3]],
-                [[0, 6], [0, 7], [0, 8], [0, 9]],
-                [[3, 0], [3, 1], [3, 2], [3, 3]],
-                [[3, 6], [3, 7], [3, 8], [3, 9]]]
+        if pattern_type == 'vertical_line':
+            #upper part of vertical
+            if part == 0:
+                mask[:, start_idx:start_idx+(size//2)+1, start_idx] = True
+            #lower part of vertical
+            elif part == 1:
+                mask[:, start_idx+(size//2)+1:start_idx+size+1, start_idx] = True
+            #left-part of horizontal
+            elif part == 2:
+                mask[:, start_idx+size//2, start_idx-size//2:start_idx+size//4 + 1] = True
+            #right-part of horizontal
+            elif part == 3:
+                mask[:, start_idx+size//2, start_idx-size//4+1:start_idx+size//2 + 1] = True
+        elif pattern_type == 'pixel':
+            for pos in PIXEL_PATTERN[part]:
+                mask[:, pos[0], pos[1]] = True
+
+    value = torch.full(shape, trigger_value, dtype=torch.float)
+    return mask, value
+
+def get_trigger(dataset, pattern_type, agent_idx, mode, val_mode, args, shape, device, dtype):
+    """ returns the cached (mask, value) pair for a trigger, compiling it on first use """
+    if mode == 'normal' or val_mode == True:
+        mode, part = 'normal', None
+    else:
+        part = agent_idx % 4
+    if args != None:
+        pattern_args = (args.pattern_size, tuple(args.pattern_location))
+    else:
+        pattern_args = None
+    key = (dataset, pattern_type, part, mode, tuple(shape), pattern_args, str(device), dtype)
+    if key not in _trigger_cache:
+        mask, value = compile_trigger(dataset, pattern_type, part, mode, shape, args)
+        _trigger_cache[key] = (mask.to(device), value.to(device=device, dtype=dtype))
+    return _trigger_cache[key]
+
+# decoded trojan images, keyed by (path, height, width, device, dtype)
+_trojan_asset_cache = {}
+
+def get_trojan_asset(path, height, width, device, dtype=torch.float):
+    """ reads, inverts and resizes a trojan image once per process and keeps it as a [H, W] tensor """
+    key = (path, height, width, str(device), dtype)
+    if key not in _trojan_asset_cache:
+        cpu_key = (path, height, width, 'cpu', torch.float)
+        if cpu_key not in _trojan_asset_cache:
+            trojan = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            trojan = cv2.bitwise_not(trojan)
+            trojan = cv2.resize(trojan, dsize=(width, height), interpolation=cv2.INTER_CUBIC)
+            _trojan_asset_cache[cpu_key] = torch.from_numpy(trojan).float()
+        _trojan_asset_cache[key] = _trojan_asset_cache[cpu_key].to(device=device, dtype=dtype)
+    return _trojan_asset_cache[key]
+
+def add_pattern_bd_batch(x, dataset='cifar10', pattern_type='square', agent_idx=-1, mode = 'normal', val_mode = False, args = None):
+    """
+    adds a trojan pattern to every image of a [B, C, H, W] batch, returns a new tensor
+    """
+    apple_path = "../apple.png"
+    logo_path = "../watermark.png"
+    if (mode == 'normal' or val_mode == True) and (dataset == 'mnist' or dataset == 'fedemnist') \
+            and (pattern_type == 'copyright' or pattern_type == 'apple'):
+        if pattern_type == 'copyright':
+            trojan = get_trojan_asset(logo_path, x.shape[-2], x.shape[-1], x.device, x.dtype)
+        else:
+            trojan = get_trojan_asset(apple_path, x.shape[-2], x.shape[-1], x.device, x.dtype)
+        return x + trojan
 
-                i = agent_idx % 4
-                for d in range(0, 3):
-                    for j in range(len(pattern_type[i])):
-                            pos = pattern_type[i][j]
-                            x[d][pos[0]][pos[1]] = trigger_value
-
-        elif dataset == 'mnist' or dataset == 'fedemnist':
-            if pattern_type == 'pixel':
-                    pattern_type = [[[0, 0], [0, 1], [0, 2], [0, 3]],
-                    [[0, 6], [0, 7], [0, 8], [0, 9]],
-                    [[3, 0], [3, 1], [3, 2], [3, 3]],
-                    [[3, 6], [3, 7], [3, 8], [3, 9]]]
-
-                    i = agent_idx % 4
-                    for j in range(len(pattern_type[i])):
-                            pos = pattern_type[i][j]
-                            x[pos[0]][pos[1]] = trigger_value
-
-            elif pattern_type == 'vertical_line':
-                start_idx = 5
-                size = 6
-                if agent_idx % 4 == 0:
-                    for i in range(start_idx, start_idx+(size//2)+1):
-                        x[i, start_idx] = trigger_value
-                            
-                #lower part of vertical
-                elif agent_idx % 4 == 1:
-                    for i in range(start_idx+(size//2)+1, start_idx+size+1):
-                        x[i, start_idx] = trigger_value
-                            
-                #left-part of horizontal
-                elif agent_idx % 4 == 2:
-                    for i in range(start_idx-size//2, start_idx+size//4 + 1):
-                        x[start_idx+size//2, i] = trigger_value
-                            
-                #right-part of horizontal
-                elif agent_idx % 4 == 3:
-                    for i in range(start_idx-size//4+1, start_idx+size//2 + 1):
-                        x[start_idx+size//2, i] = trigger_value
-    x = x.reshape(original_shape)
-    return x
\ No newline at end of file
+    mask, value = get_trigger(dataset, pattern_type, agent_idx, mode, val_mode, args, x.shape[1:], x.device, x.dtype)
+    return torch.where(mask, value, x)
+
+def add_pattern_bd(x, dataset='cifar10', pattern_type='square', agent_idx=-1, mode = 'normal', val_mode = False, args = None):
+    """
+    adds a trojan pattern to a single [C, H, W] image
+    """
+    return add_pattern_bd_batch(x.unsqueeze(0), dataset, pattern_type, agent_idx, mode, val_mode, args)[0]
\ No newline at end of file
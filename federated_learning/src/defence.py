@@ -1,22 +1,33 @@
 import torch
+from torch.func import functional_call, vmap
 from sklearn.metrics.pairwise import pairwise_distances
-#import hdbscan
+try:
+    import hdbscan
+except ImportError:
+    # only the clustering defences need it, Aggregation refuses to run flame without it
+    hdbscan = None
 import numpy as np
 from copy import deepcopy
 import random
 from options import args_parser
+from data_loader import get_image_parameter
+from metrics import OutputLayer, neups_metric, te_metric
+from update_geometry import UpdateGeometry, as_geometry
+from sketch import exact_row_cosine_distance, flame_borderline
 import math
 import matplotlib.pyplot as plt
 
 args = args_parser()
+# input shape and number of classes of the dataset
+get_image_parameter(args)
 #########################improved Flame###############################
 def improved_flame(grad_in, cluster_sel=0):    #adjusted cosine distance filter
     """The HDBSCAN filter based on cosine distance
     Args:
-        grad_in (list/np.ndarray): the raw input weight_diffs
+        grad_in (list/np.ndarray/UpdateGeometry): the raw input weight_diffs or the round's shared geometry
     """
     # distance_matrix = pairwise_distances(grad_in - grad_in.mean(axis=0), metric='cosine')   #adjusted cosine distance
-    distance_matrix = pairwise_distances(grad_in, metric='cosine')
+    distance_matrix = as_geometry(grad_in).cosine_distance().cpu().numpy()
     return improved_flame_filter(distance_matrix, cluster_sel=cluster_sel)
 
 def improved_flame_filter(inputs, cluster_sel=0):
@@ -61,22 +72,41 @@ def improved_flame_filter(inputs, cluster_sel=0):
 def cosine_distance_filter(grad_in, cluster_sel=0):
     """The HDBSCAN filter based on cosine distance
     Args:
-        grad_in (list/np.ndarray): the raw input weight_diffs
+        grad_in (list/np.ndarray/UpdateGeometry): the raw input weight_diffs or the round's shared geometry
     """
     #distance_matrix = pairwise_distances(grad_in - grad_in.mean(axis=0), metric='cosine')  # adjusted cosine distance
-    distance_matrix = pairwise_distances(grad_in, metric='cosine')
+    distance_matrix = as_geometry(grad_in).cosine_distance().cpu().numpy()
     return hdbscan_filter(distance_matrix, cluster_sel=cluster_sel)
 ###################################Flame##############################
 
 def flame(grad_in, cluster_sel=0):
     """The HDBSCAN filter based on cosine distance
     Args:
-        grad_in (list/np.ndarray): the raw input weight_diffs
+        grad_in (list/np.ndarray/UpdateGeometry): the raw input weight_diffs or the round's shared geometry
     """
     # distance_matrix = pairwise_distances(grad_in - grad_in.mean(axis=0), metric='cosine')   #adjusted cosine distance
-    distance_matrix = pairwise_distances(grad_in, metric='cosine')
+    distance_matrix = as_geometry(grad_in).cosine_distance().cpu().numpy()
     return flame_filter(distance_matrix, cluster_sel=cluster_sel)
 
+def sketched_flame(sketches, updates, eps, block_size, cluster_sel=0):
+    """FLAME clustering on the cosine distances of the [n, k] sketches, the rows whose
+    decision is within the sketch error are refined with their exact distances and clustered again
+    Args:
+        sketches (torch.Tensor): the stacked sketches of the updates
+        updates (list): the raw updates, in the order of the sketches
+        eps (float): the error bound of the sketches
+    """
+    distance_matrix = as_geometry(sketches).cosine_distance()
+    bengin_id = flame_filter(distance_matrix.cpu().numpy(), cluster_sel=cluster_sel)
+    # every sketched cosine distance is within 2 eps / (1 - eps) of the exact one, a difference of two within twice that
+    rows = flame_borderline(distance_matrix, bengin_id, 4 * eps / (1 - eps))
+    if len(rows) > 0:
+        exact_distances = exact_row_cosine_distance(updates, rows.to(updates[0].device), block_size).to(distance_matrix)
+        distance_matrix[rows] = exact_distances
+        distance_matrix[:, rows] = exact_distances.T
+        bengin_id = flame_filter(distance_matrix.cpu().numpy(), cluster_sel=cluster_sel)
+    return bengin_id
+
 def flame_filter(inputs, cluster_sel=0):
     cluster_base = hdbscan.HDBSCAN(
         #metric='l2',
@@ -184,134 +214,102 @@ def neups_filter(inputs, cluster_sel=0):
     #return bengin_id
     return label
 
-#########################NEUP_calc#######################
-def neups_metric(grad_in: np.ndarray):
-    """NEUPs measures the magnitude changes of neurons in the last layer
-    and use them to provide a rough estimation of the output labels for
-    the training data of the individual client
-    Args:
-        grad_in (np.ndarray): the raw input weight_diffs
-    Returns:
-        [np.ndarray]: 2-dimession NormalizEd Energies UPdate for clients
-    """
-    if args.data == 'minist' or 'fmnist':
-        weight_index = 1290
-        bias_index = 10
-    elif args.data == 'cifar10':
-        weight_index = 2570
-        bias_index = 10
-    neups = []
-    for client_grad in grad_in: #number of clients
-        energy_weights = client_grad[-weight_index:-bias_index].reshape((bias_index, -1)) #row = bias_index(num_neuron)
-        energy_bias = client_grad[-bias_index::]
-        energy_neuron = np.square(np.abs(energy_weights).sum(axis=1) + np.abs(energy_bias))
-        energy_neuron /= energy_neuron.sum()
-        neups.append(energy_neuron.tolist())
-
-    return np.array(neups)
-
-def neups_filter(grad_in): #grad_in: updates
+#########################NEUPs & TEs#######################
+# neups_metric and te_metric live in metrics.py, sliced by the OutputLayer of the model
+def neups_filter(grad_in, output_layer): #grad_in: updates
     """The HDBSCAN filter based on NEUPS
     Args:
     grad_in (list/np.ndarray): the raw input weight_diffs
+    output_layer (OutputLayer): the output layer of the model
     """
 
-    neups = neups_metric(grad_in)
+    neups = neups_metric(grad_in, output_layer)
     return hdbscan_filter(neups)
 
-#########################TE(Threshold Exceedings)_calc#######################
-def te_metric(neups):
-    """TEs analyzes the parameter updates of the output layer for a model
-    to measure the homogeneity of its training data
-    Args:
-        neups ([np.ndarray]): NormalizEd Energies UPdate
-    Returns:
-        [np.ndarray]: the number of threshold exceedings
-    """
-    #if args.data == 'minist' or 'fmnist' or 'cifar10':
-    #bias_index = 10
-    #elif args.data == 'tiny':
-    #    bias_index = 10
-    te = []
-    bias_index = 10
-    for client_neups in neups:
-        threshold = max(0.01, 1 / bias_index) * client_neups.max()
-        te.append((client_neups > threshold).sum())
-
-    return te
-
 #########################DDifs_calc#######################
-def ddifs_metric(model, grad_in: np.ndarray, seed, samples_size=20000):
+def ddifs_metric(model, grad_in, seed, samples_size=20000, chunk_size=8):
        # DDifs measures the difference of predicted scores between local update model
        # and global model as they provide information about distribution of the training
        # labels of the respective client
        # Args:
-       #     grad_in (np.ndarray): the raw input weight_diffs
+       #     grad_in (np.ndarray/torch.Tensor): the raw input weight_diffs
+       #     seed (int): seed of the random samples
        #     samples_size (int, optional): the number of random samples. Defaults to 20000.
+       #     chunk_size (int, optional): the number of clients evaluated together. Defaults to 8.
        # Returns:
-       #     [list]: the DDifs for 3 different seeds as a list of 3 lists
+       #     [list]: the DDifs of every client, one value per output neuron
+       # The local models are never built, every client's parameters are the global ones plus
+       # its update, run through functional_call, and the global output is computed only once.
 
-    ddifs = []
-    random.seed(seed)
-    if args.data == 'mnist' or 'fmnist':
-        random_samples = torch.randn(samples_size, 1, 28, 28, device = args.device)
-    elif args.data =='cifar10':
-        random_samples = torch.randn(samples_size, 3, 32, 32, device=args.device)
-    # cifar10 tiny-imagenet else:
-    for client_grad in grad_in:
-        temp_model = deepcopy(model)  #global_model
-        upgrade(client_grad.tolist(), temp_model)  #local_model
-        temp_output = temp_model.forward(random_samples).detach().cpu().data
-        model_output = model.forward(random_samples).detach().cpu().data
-        neuron_diff = torch.div(temp_output, model_output).sum(axis=0) / samples_size
-        ddifs.append(neuron_diff.numpy().tolist())
+    updates = torch.as_tensor(grad_in, dtype=torch.float32, device=args.device)
+    generator = torch.Generator(device=args.device).manual_seed(seed)
+    random_samples = torch.randn(samples_size, args.input_channel, args.input_height, args.input_width,
+                                 generator=generator, device=args.device)
+
+    global_params = {name: param.detach() for name, param in model.named_parameters()}
+    # train mode batchnorm would update the running stats, so every forward gets its own copy of them
+    buffers = {name: buf.detach() for name, buf in model.named_buffers()}
+    with torch.no_grad():
+        model_output = functional_call(model, (global_params, clone_buffers(buffers)), (random_samples,))
+
+        ddifs = []
+        for start in range(0, len(updates), chunk_size):
+            client_params = stack_client_params(global_params, updates[start:start + chunk_size])
+            if len(buffers) == 0:
+                temp_output = vmap(lambda params: functional_call(model, params, (random_samples,)))(client_params)
+            else:
+                temp_output = torch.stack([functional_call(model, ({name: param[i] for name, param in client_params.items()}, clone_buffers(buffers)), (random_samples,))
+                                           for i in range(len(updates[start:start + chunk_size]))])
+            neuron_diff = torch.div(temp_output, model_output).sum(axis=1) / samples_size
+            ddifs.append(neuron_diff.cpu())
 
-    return ddifs
+    return torch.cat(ddifs).numpy().tolist()
 
+def stack_client_params(global_params, updates):
+    """ the parameters of len(updates) local models as a dict of [c, ...] tensors, global params plus each update """
+    client_params, offset = {}, 0
+    for name, param in global_params.items():
+        layer_diff = updates[:, offset:offset + param.numel()].view((len(updates),) + tuple(param.shape))
+        client_params[name] = param.unsqueeze(0) + layer_diff.to(param.dtype)
+        offset += param.numel()
+    return client_params
 
-def upgrade(grad_in: list, model):
-    layer = 0
-    _level_length = [0]
-    for param in model.parameters():
-        _level_length.append(param.data.numel() + _level_length[-1])
-    for param in model.parameters():
-        layer_diff = grad_in[_level_length[layer]:_level_length[layer + 1]]  #list[layer parameter numbers]
-        param.data += torch.tensor(layer_diff, device=args.device).view(param.data.size())
-        layer += 1
+def clone_buffers(buffers):
+    return {name: buf.clone() for name, buf in buffers.items()}
 
 #########################Dpsight_cluster#######################
-def dpsight_cluster(weights,model):
-    cos_label = hdbscan_filter(dp_cos_dist(weights), cluster_sel=0)  ####dp_cos_dist calc bias dist
+def dpsight_cluster(weights,model,output_layer=None,geometry=None):
+    output_layer = OutputLayer(model) if output_layer == None else output_layer
+    cos_label = hdbscan_filter(dp_cos_dist(weights, output_layer, geometry), cluster_sel=0)  ####dp_cos_dist calc bias dist
     cos_dist = (cos_label[:, None] == cos_label) * 1    #array 10 x 10
-    neups_label = neups_filter(weights)
+    neups_label = neups_filter(weights, output_layer)
     neups_dist = (neups_label[:, None] == neups_label) * 1  #array
-    ddifs_dist = np.zeros((args.num_agents, args.num_agents))
+    ddifs_dist = np.zeros((len(weights), len(weights)))
     for seed in range(3):
         ddifs_label = hdbscan_filter(ddifs_metric(model, weights, seed, samples_size=1))
-        ddifs_dist += (np.array([x == y for x in ddifs_label for y in ddifs_label]) * 1).reshape(args.num_agents,args.num_agents)  # list
+        ddifs_dist += (ddifs_label[:, None] == ddifs_label) * 1
     merged_ddif_clust_dist = ddifs_dist / 3
     merged_dist = (merged_ddif_clust_dist + neups_dist + cos_dist) / 3
     clusters = hdbscan_filter(merged_dist)
     return clusters
 
 #########################Dpsight_filter#######################
-def dpsight_filter(weights,model):
-    neups = neups_metric(weights)
-    te = np.array(te_metric(neups))     #list: num of clients to array
+def dpsight_filter(weights,model,output_layer=None):
+    output_layer = OutputLayer(model) if output_layer == None else output_layer
+    neups = neups_metric(weights, output_layer)
+    te = te_metric(neups)     #array: one count per client
     class_boundary = np.median(te) / 2
-    label = np.empty(args.num_agents)
-    for i in range(args.num_agents):
-        label[i] = 1 if te[i] <= class_boundary else 0
+    label = (te <= class_boundary) * 1.
 
     return label
 
 #########################Dpsight_cos_filter#######################
-def dp_cos_dist(weights):
-    if args.data == 'minist' or 'fmnist':
-        bias_index = 10
-    elif args.data == 'cifar10':
-        bias_index = 10
-    cos_dist = pairwise_distances(weights[:,-bias_index:], metric='cosine')
+def dp_cos_dist(weights, output_layer, geometry=None):
+    if output_layer.bias_start == None:
+        # no bias, the zero bias rows of OutputLayer.bias are orthogonal to each other
+        return as_geometry(output_layer.bias(torch.as_tensor(weights))).cosine_distance().cpu().numpy()
+    geometry = as_geometry(weights) if geometry == None else geometry
+    cos_dist = geometry.slice(output_layer.bias_start, output_layer.bias_end).cosine_distance().cpu().numpy()
     #a = weights[:,-bias_index:]
     return cos_dist
 
@@ -320,9 +318,12 @@ def dpsight(weights,model):
     accepted_models = []
     grad_in=weights.tolist()
     amount_of_positives = 0
-    cluster = dpsight_cluster(weights, model)
+    # the output layer slice is derived from the model once and shared by all the metrics
+    output_layer = OutputLayer(model)
+    geometry = UpdateGeometry(torch.as_tensor(weights), model=model)
+    cluster = dpsight_cluster(weights, model, output_layer, geometry)
     print("cluster: ",cluster)
-    label = dpsight_filter(weights, model)
+    label = dpsight_filter(weights, model, output_layer)
     print("label: ", label)
     label_, indices = np.unique(cluster, return_counts=True)
     for i in label_:
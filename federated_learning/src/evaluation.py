@@ -0,0 +1,187 @@
+import torch
+import torch.nn as nn
+import copy
+import queue
+import threading
+import time
+import traceback
+from torch.nn.utils import parameters_to_vector
+
+import data_loader
+import functions
+
+
+class Evaluator():
+    """
+    evaluates the global model on a validation set that is materialized on the device once,
+    the stamped poison set of the static triggers (normal, DBA) is cached as well, so every
+    snap round only runs the forward passes, clean and all poison batches go through the model together
+    """
+    def __init__(self, args, poisoned_val_set, criterion, writer):
+        self.args = args
+        self.criterion = criterion
+        self.writer = writer
+        self.num_classes = args.num_classes
+        self.val_inputs, self.val_labels = self.materialize(poisoned_val_set)
+        self.poison_labels = data_loader.target_transform(self.val_labels, args)
+
+        self.static_trigger = args.attack_mode == 'normal' or args.attack_mode == 'DBA'
+        if self.static_trigger:
+            self.poison_inputs = torch.cat([self.stamp(self.val_inputs[start:start + args.bs])
+                                            for start in range(0, len(self.val_inputs), args.bs)])
+
+    def materialize(self, dataset):
+        """ the whole validation set as one input and one label tensor on the device """
+        inputs, labels = [], []
+        for start in range(0, len(dataset), self.args.bs):
+            batch_inputs, batch_labels = dataset.get_batch(start, min(start + self.args.bs, len(dataset)))
+            inputs.append(batch_inputs.to(self.args.device))
+            labels.append(batch_labels.view(-1).to(self.args.device))
+        return torch.cat(inputs), torch.cat(labels)
+
+    def stamp(self, inputs):
+        """ the full (val_mode) pattern of the normal and DBA attacks """
+        return data_loader.add_pattern_bd_batch(inputs, self.args.data, self.args.pattern_type, -1,
+                                                self.args.attack_mode, True, self.args)
+
+    def apply_trigger(self, inputs, trigger):
+        """ the poisoned inputs of a batch, trigger is the generator or the noise vector of the current round """
+        if self.args.attack_mode == 'trigger_generation':
+            return trigger(inputs) * self.args.noise_eps + inputs
+        if not(trigger.shape[-1] == inputs.shape[-1] and trigger.shape[-2] == inputs.shape[-2]):
+            filled_zero_shape = (0, inputs.shape[-1] - trigger.shape[-1], 0, inputs.shape[-2] - trigger.shape[-2])
+            trigger = nn.functional.pad(trigger, filled_zero_shape, 'constant', 0)
+        return torch.clamp(inputs + trigger, 0.0, 1.0)
+
+    def has_trigger(self, trigger):
+        """ normal and DBA stamp their pattern, the generator modes need the round's trigger, every other mode poisons nothing """
+        if self.static_trigger:
+            return True
+        return (self.args.attack_mode == 'trigger_generation' or self.args.attack_mode == 'fixed_generator') and trigger is not None
+
+    def poison_batch(self, start, end, trigger):
+        if self.static_trigger:
+            return self.poison_inputs[start:end]
+        return self.apply_trigger(self.val_inputs[start:end], trigger)
+
+    @torch.no_grad()
+    def evaluate(self, model, rnd, triggers = (None,), clean = True):
+        """
+        returns the clean (loss, (accuracy, per class accuracy)), None if not asked for, and one such result per trigger,
+        every validation batch goes through the model once as a [(1 + k) * B] stack of the clean batch and its k poisoned copies,
+        a trigger that poisons nothing is skipped and gets zero stats
+        """
+        start_time = time.perf_counter()
+        # disable BN stats during inference
+        model.eval()
+        clean_stats = functions.new_eval_stats(self.num_classes, self.args.device)
+        poison_stats = [functions.new_eval_stats(self.num_classes, self.args.device) for _ in triggers]
+        active_triggers = [trigger for trigger in triggers if self.has_trigger(trigger)]
+        active_stats = [stats for stats, trigger in zip(poison_stats, triggers) if self.has_trigger(trigger)]
+        for start in range(0, len(self.val_inputs), self.args.bs):
+            if not clean and len(active_triggers) == 0:
+                break
+            end = min(start + self.args.bs, len(self.val_inputs))
+            batches = [self.val_inputs[start:end]] if clean else []
+            batches += [self.poison_batch(start, end, trigger) for trigger in active_triggers]
+            outputs = model(torch.cat(batches)).split(end - start)
+            if clean:
+                functions.update_eval_stats(clean_stats, outputs[0], self.val_labels[start:end], self.criterion, self.num_classes)
+            for stats, trigger_outputs in zip(active_stats, outputs[len(outputs) - len(active_triggers):]):
+                functions.update_eval_stats(stats, trigger_outputs, self.poison_labels[start:end], self.criterion, self.num_classes)
+
+        clean_result = None
+        if clean:
+            clean_result = functions.finish_eval_stats(clean_stats, len(self.val_inputs), self.num_classes)
+        poison_results = [functions.finish_eval_stats(stats, len(self.val_inputs), self.num_classes) for stats in poison_stats]
+        # finish_eval_stats has synced with the device, so this is the full latency
+        self.writer.add_scalar('Evaluation/Latency', time.perf_counter() - start_time, rnd)
+        return clean_result, poison_results
+
+
+def snap_evaluation(args, evaluator, model, rnd, triggers, writer, data_dict = None):
+    """ 
+    the clean and poison evaluation of a snap round, prints the results and writes them to tensorboard,
+    returns the lines for accuracy_record.txt and the poison accuracy
+    """
+    record = ['current rnd is {}'.format(rnd)]
+    print('**** start testing ****')
+    if args.data != 'reddit':
+        (val_loss, (val_acc, val_per_class_acc)), poison_results = evaluator.evaluate(model, rnd, triggers)
+        writer.add_scalar('Validation/Loss', val_loss, rnd)
+        writer.add_scalar('Validation/Accuracy', val_acc, rnd)
+        print(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
+        print(f'| Val_Per_Class_Acc: {val_per_class_acc} ')
+        record.append(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
+    else:
+        val_loss, val_acc = functions.test_reddit_normal(args, data_dict, model)
+        print(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
+        record.append(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
+
+    if args.data != 'reddit':
+        if args.attack_mode == 'fixed_generator' and args.seperate_vector == True:
+            for vector_index, (poison_loss, (poison_acc, _)) in enumerate(poison_results):
+                print(f'| Vector {vector_index:d} - Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
+                record.append(f'| Vector {vector_index:d} - Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
+        else:
+            poison_loss, (poison_acc, _) = poison_results[0]
+    else:
+        poison_loss, poison_acc = functions.test_reddit_poison(args, data_dict, model)
+
+    if args.seperate_vector == False:
+        print(f'| Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
+        record.append(f'| Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
+    return record, poison_acc
+
+
+class AsyncEvaluator():
+    """
+    runs snap_evaluation on a thread with its own replica of the global model, so training goes on meanwhile,
+    submit snapshots the parameters, buffers and triggers of the round, join hands back the records in round order
+    """
+    def __init__(self, args, evaluator, global_model, writer, data_dict = None):
+        self.args = args
+        self.evaluator = evaluator
+        self.writer = writer
+        self.data_dict = data_dict
+        self.replica = copy.deepcopy(global_model)
+        self.results = []
+        self.error = None
+        # at most two snapshots wait, training blocks instead of piling them up when evaluation is the slower one
+        self.tasks = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, rnd, global_model, triggers):
+        if self.error != None:
+            raise RuntimeError('evaluation worker failed:\n{}'.format(self.error))
+        params = parameters_to_vector(global_model.parameters()).detach().clone()
+        buffers = [buf.detach().clone() for buf in global_model.buffers()]
+        triggers = [copy.deepcopy(trigger) for trigger in triggers]
+        self.tasks.put((rnd, params, buffers, triggers))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task == None:
+                break
+            if self.error != None:
+                # keep draining after a failure, so submit and join never block on a full queue
+                continue
+            rnd, params, buffers, triggers = task
+            try:
+                functions.load_parameters(self.replica, params)
+                functions.load_buffers(self.replica, buffers)
+                with torch.no_grad():
+                    record, poison_acc = snap_evaluation(self.args, self.evaluator, self.replica, rnd, triggers, self.writer, self.data_dict)
+                self.results.append((rnd, record, poison_acc))
+            except Exception:
+                self.error = traceback.format_exc()
+
+    def join(self):
+        """ waits for the submitted evaluations, returns (rnd, record, poison_acc) of each in round order """
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error != None:
+            raise RuntimeError('evaluation worker failed:\n{}'.format(self.error))
+        return sorted(self.results, key=lambda result: result[0])
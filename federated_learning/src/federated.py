@@ -8,6 +8,9 @@ from agent import Agent
 from tqdm import tqdm
 from options import args_parser
 from aggregation import Aggregation
+from client_pool import ClientPool
+from evaluation import Evaluator, AsyncEvaluator, snap_evaluation
+import cohort
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
 import torch.nn as nn
@@ -55,6 +58,8 @@ if __name__ == '__main__':
     '''
 
     args.server_lr = args.server_lr if args.aggr == 'sign' else 1.0
+    if args.seed != None:
+        functions.seed_everything(args.seed)
     test_accuracy_record = []
     functions.print_exp_details(args, test_accuracy_record)
     
@@ -72,11 +77,11 @@ if __name__ == '__main__':
     # load dataset and user groups (i.e., user to data mapping)
     if args.data != 'reddit':
         train_dataset, val_dataset = data_loader.get_datasets(args)
+        data_dict = None
     else:
         data_dict = data_loader.get_datasets(args)
 
     if args.data != 'reddit':
-        val_loader = DataLoader(val_dataset, batch_size=args.bs, shuffle=False, num_workers=args.num_workers, pin_memory=False)
         user_groups = data_loader.distribute_data(train_dataset, args)
         functions.print_distribution(user_groups, args.num_classes, train_dataset)
         # poison the validation dataset
@@ -84,6 +89,8 @@ if __name__ == '__main__':
 
     # initialize a model, and the agents
     global_model = data_loader.get_classification_model(args).to(args.device)
+    # every parameter is a view into flat_params, so resetting the model between agents is a single copy_
+    flat_params = functions.flatten_parameters(global_model)
 
     if args.data != 'reddit':
         trigger_model_using = data_loader.get_noise_generator(args).to(args.device)
@@ -117,28 +124,87 @@ if __name__ == '__main__':
     n_model_params = len(parameters_to_vector(global_model.parameters()))
     aggregator = Aggregation(agent_data_sizes, n_model_params, args, writer)
     criterion = nn.CrossEntropyLoss().to(args.device)
+    evaluator = None
+    if args.data != 'reddit':
+        # the validation set lives on the device from here on, with the poisoned copy for static triggers
+        evaluator = Evaluator(args, poisoned_val_set, criterion, writer)
+    # or the snap rounds are evaluated on a background thread while the next rounds train
+    async_evaluator = None
+    if args.async_eval == True:
+        async_evaluator = AsyncEvaluator(args, evaluator, global_model, writer, data_dict)
+
+    # train the selected agents of a round in parallel worker processes
+    client_pool = None
+    if args.client_workers > 0:
+        client_pool = ClientPool(args, agents, global_model, criterion, [trigger_model_using, trigger_model_target, trigger_vector_using, trigger_vector_target])
+    # or train the benign agents of a round cohort_size at a time with one vmapped model
+    if args.cohort_size > 0:
+        cohort.check_cohort_support(args, global_model)
+
+    # avg and sign fold every update into running sums instead of keeping all of them
+    streaming = aggregator.supports_streaming()
+    # the round's copy of the global model and the updates of the sequential path are written into these every round,
+    # a streamed update is folded in before the next agent trains, so one row is reused, the worker pool needs none
+    rnd_global_params = torch.empty_like(flat_params)
+    rnd_updates = None
+    if client_pool == None:
+        n_update_rows = 1 if streaming else math.floor(args.num_agents*args.agent_frac)
+        rnd_updates = torch.empty(n_update_rows, n_model_params, 
+                                  dtype=getattr(torch, args.update_dtype), device=flat_params.device)
 
     # training loop
     for rnd in tqdm(range(1, args.rounds+1)):
         if args.restrain_lr and rnd % 10 == 0:
             args.client_lr = args.client_lr * 0.5
-        rnd_global_params = parameters_to_vector(global_model.parameters()).detach()
+        rnd_global_params.copy_(flat_params)
+        rnd_global_buffers = [buf.detach().clone() for buf in global_model.buffers()]
         agent_updates_dict = {}
-        for agent_id in np.random.choice(args.num_agents, math.floor(args.num_agents*args.agent_frac), replace=False):
-            if args.data != 'reddit':
-                update = agents[agent_id].local_train(global_model, criterion, rnd, [trigger_model_using, trigger_model_target, trigger_vector_using, trigger_vector_target])
-            else:
-                sampling = random.sample(range(len(data_dict['train_data'])), args.num_agents)
-                update = agents[agent_id].local_reddit_train(global_model, criterion, rnd, data_dict, sampling)
+        # every agent starts from the round's buffers, the global model gets their data-size weighted mean
+        buffer_sums, buffer_weight = None, 0
+        selected_agents = np.random.choice(args.num_agents, math.floor(args.num_agents*args.agent_frac), replace=False)
+        if client_pool != None:
+            trained_agents = client_pool.train_round(rnd, selected_agents, global_model)
+        elif args.cohort_size > 0:
+            trained_agents = cohort.train_in_cohorts(agents, global_model, args, rnd, selected_agents)
+        else:
+            trained_agents = ((agent_id, None) for agent_id in selected_agents)
+        for position, (agent_id, update) in enumerate(trained_agents):
+            if update is None:
+                update_out = rnd_updates[0] if streaming else rnd_updates[position]
+                # every agent starts from the round's buffers too, batchnorm stats don't leak between agents
+                functions.load_buffers(global_model, rnd_global_buffers)
+                with functions.local_training_rng(args, rnd, agent_id):
+                    if args.data != 'reddit':
+                        update = agents[agent_id].local_train(global_model, criterion, rnd, [trigger_model_using, trigger_model_target, trigger_vector_using, trigger_vector_target],
+                                                              initial_params=rnd_global_params, update_out=update_out)
+                    else:
+                        sampling = random.sample(range(len(data_dict['train_data'])), args.num_agents)
+                        update = agents[agent_id].local_reddit_train(global_model, criterion, rnd, data_dict, sampling,
+                                                                     initial_params=rnd_global_params, update_out=update_out)
+                # make sure every agent gets same copy of the global model in a round (i.e., they don't affect each other's training)
+                flat_params.copy_(rnd_global_params)
+            # the pool leaves the buffers of the agent it yields in global_model as well
+            if len(rnd_global_buffers) > 0:
+                buffer_sums = functions.accumulate_buffers(buffer_sums, global_model.buffers(), aggregator.agent_weight(agent_id))
+                buffer_weight += aggregator.agent_weight(agent_id)
             if rnd >= args.attack_start_round and args.save_checkpoint == True:
-                torch.save(update, os.path.join(args.storing_dir, 'round_{}_agent_{}_update.pt'.format(rnd, agent_id)))
+                # clone, a row of rnd_updates would otherwise save the whole buffer
+                torch.save(update.clone(), os.path.join(args.storing_dir, 'round_{}_agent_{}_update.pt'.format(rnd, agent_id)))
 
             if not (args.underwater_attacker == True and agent_id < args.num_corrupt):
-                agent_updates_dict[agent_id] = update
-            # make sure every agent gets same copy of the global model in a round (i.e., they don't affect each other's training)
-            vector_to_parameters(copy.deepcopy(rnd_global_params), global_model.parameters())
+                if streaming:
+                    aggregator.accumulate_update(agent_id, update)
+                else:
+                    agent_updates_dict[agent_id] = update
+                    aggregator.sketch_update(agent_id, update, rnd)
+            del update
+        if buffer_sums is not None:
+            functions.load_buffer_mean(global_model, buffer_sums, buffer_weight)
         # aggregate params obtained by agents and update the global params
-        aggregator.aggregate_updates(global_model, agent_updates_dict, rnd)
+        if streaming:
+            aggregator.aggregate_streamed_updates(global_model, rnd)
+        else:
+            aggregator.aggregate_updates(global_model, agent_updates_dict, rnd)
         
         if rnd >= args.attack_start_round and args.save_trigger ==  True and args.attack_mode == 'fixed_generator':
             if args.seperate_vector==True:
@@ -158,46 +224,26 @@ if __name__ == '__main__':
                 torch.save(global_model.state_dict(), os.path.join(args.storing_dir, 'rnd_{}.pt'.format(rnd)))
         # inference in every args.snap rounds
         if rnd % args.snap == 0:
-            test_accuracy_record.append('current rnd is {}'.format(rnd))
-            print(f'**** start testing ****')
-            with torch.no_grad():
-                if args.data != 'reddit':
-                    val_loss, (val_acc, val_per_class_acc) = functions.get_loss_n_accuracy_normal(global_model, criterion, val_loader, args, args.num_classes)
-                    writer.add_scalar('Validation/Loss', val_loss, rnd)
-                    writer.add_scalar('Validation/Accuracy', val_acc, rnd)
-                    print(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
-                    print(f'| Val_Per_Class_Acc: {val_per_class_acc} ')
-                    test_accuracy_record.append(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
-                else:
-                    val_loss, val_acc = functions.test_reddit_normal(args, data_dict, global_model)
-                    print(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
-                    test_accuracy_record.append(f'| Val_Loss/Val_Acc: {val_loss:.3f} / {val_acc:.3f} |')
-
-                if args.data != 'reddit':
-                    if args.attack_mode == 'fixed_generator':
-                        if args.seperate_vector == True:
-                            for vector_index in range(len(trigger_vector_target)):
-                                poison_loss, (poison_acc, _) = functions.get_loss_n_accuracy_poison(global_model, trigger_vector_target[vector_index], criterion,  poisoned_val_set, args, args.num_classes)
-                                print(f'| Vector {vector_index:d} - Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
-                                test_accuracy_record.append(f'| Vector {vector_index:d} - Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
-                        else: 
-                            poison_loss, (poison_acc, _) = functions.get_loss_n_accuracy_poison(global_model, trigger_vector_target, criterion,  poisoned_val_set, args, args.num_classes)
-                    elif args.attack_mode == 'trigger_generation':
-                        poison_loss, (poison_acc, _) = functions.get_loss_n_accuracy_poison(global_model, trigger_model_target, criterion,  poisoned_val_set, args, args.num_classes)
-                    else:
-                        poison_loss, (poison_acc, _) = functions.get_loss_n_accuracy_poison(global_model, None, criterion,  poisoned_val_set, args, args.num_classes)
+            triggers = None
+            if args.data != 'reddit':
+                if args.attack_mode == 'fixed_generator':
+                    # with seperate vectors every vector gets its own poison result out of the same sweep
+                    triggers = trigger_vector_target if args.seperate_vector == True else [trigger_vector_target]
+                elif args.attack_mode == 'trigger_generation':
+                    triggers = [trigger_model_target]
                 else:
-                    poison_loss, poison_acc = functions.test_reddit_poison(args, data_dict, global_model)
-    
-
+                    triggers = [None]
+            if async_evaluator != None:
+                async_evaluator.submit(rnd, global_model, triggers)
+            else:
+                with torch.no_grad():
+                    record, poison_acc = snap_evaluation(args, evaluator, global_model, rnd, triggers, writer, data_dict)
+                test_accuracy_record += record
                 cum_poison_acc_mean += poison_acc
                 #writer.add_scalar('Poison/Base_Class_Accuracy', val_per_class_acc[args.base_class], rnd)
                 #writer.add_scalar('Poison/Poison_Accuracy', poison_acc, rnd)
                 #writer.add_scalar('Poison/Poison_Loss', poison_loss, rnd)
                 #writer.add_scalar('Poison/Cumulative_Poison_Accuracy_Mean', cum_poison_acc_mean/rnd, rnd) 
-                if args.seperate_vector == False:
-                    print(f'| Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
-                    test_accuracy_record.append(f'| Poison Loss/Poison Acc: {poison_loss:.3f} / {poison_acc:.3f} |')
                 '''
                 if args.num_corrupt > 0 and rnd >= args.attack_start_round:
                     if args.attack_mode == 'fixed_generator':
@@ -207,6 +253,13 @@ if __name__ == '__main__':
                     else:
                         functions.compare_images(None, poisoned_val_set, args, rnd)
                 '''
+    if client_pool != None:
+        client_pool.close()
+    if async_evaluator != None:
+        for rnd, record, poison_acc in async_evaluator.join():
+            test_accuracy_record += record
+            cum_poison_acc_mean += poison_acc
+
     if args.save_model:
             torch.save(global_model.state_dict(), os.path.join(args.storing_dir, 'final_model_{}.pt'.format(args.data)))
             
@@ -5,6 +5,8 @@ from attack_models.autoencoders import *
 from attack_models.unet import *
 
 import copy
+import random
+from contextlib import contextmanager
 
 from data_loader import *
 from utils.text_load import *
@@ -84,44 +86,53 @@ def test_reddit_poison(args, reddit_data_dict, model):
     model.train()
     return total_l, acc
 
+def new_eval_stats(num_classes, device):
+    """ running loss, number of correct predictions and confusion matrix of an evaluation, kept on device """
+    return {'loss': torch.zeros((), dtype=torch.float64, device=device),
+            'correct': torch.zeros((), dtype=torch.long, device=device),
+            'confusion_matrix': torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)}
+
+def update_eval_stats(stats, outputs, labels, criterion, num_classes):
+    """ adds one batch to the running stats without syncing with the device """
+    labels = labels.view(-1).long()
+    stats['loss'] += criterion(outputs, labels).double() * outputs.shape[0]
+    _, pred_labels = torch.max(outputs, 1)
+    stats['correct'] += torch.eq(pred_labels, labels).sum()
+    # one bincount over t * C + p fills the whole confusion matrix of the batch
+    stats['confusion_matrix'] += torch.bincount(labels * num_classes + pred_labels, minlength=num_classes * num_classes)
+
+def finish_eval_stats(stats, n_samples, num_classes):
+    """ returns the loss and total accuracy, per class accuracy, the only sync of the evaluation """
+    confusion_matrix = stats['confusion_matrix'].view(num_classes, num_classes).float().cpu()
+    avg_loss = stats['loss'].item() / n_samples
+    accuracy = stats['correct'].item() / n_samples
+    per_class_accuracy = confusion_matrix.diag() / confusion_matrix.sum(1)
+    return avg_loss, (accuracy, per_class_accuracy)
+
 def get_loss_n_accuracy_normal(model, criterion, data_loader, args, num_classes=10):
     """ Returns the loss and total accuracy, per class accuracy on the supplied data loader """
     
     # disable BN stats during inference
     model.eval()                                      
-    total_loss, correctly_labeled_samples = 0, 0
-    confusion_matrix = torch.zeros(num_classes, num_classes)
+    stats = new_eval_stats(num_classes, args.device)
             
     # forward-pass to get loss and predictions of the current batch
     for _, (inputs, labels) in enumerate(data_loader):
         inputs, labels = inputs.to(device=args.device, non_blocking=True),\
                 labels.to(device=args.device, non_blocking=True)
                                             
-        # compute the total loss over minibatch
+        # accumulate loss, correct predictions and the confusion matrix on device
         outputs = model(inputs)
-        avg_minibatch_loss = criterion(outputs, labels)
-        total_loss += avg_minibatch_loss.item()*outputs.shape[0]
-                        
-        # get num of correctly predicted inputs in the current batch
-        _, pred_labels = torch.max(outputs, 1)
-        pred_labels = pred_labels.view(-1)
-        correctly_labeled_samples += torch.sum(torch.eq(pred_labels, labels)).item()
-        # fill confusion_matrix
-        for t, p in zip(labels.view(-1), pred_labels.view(-1)):
-            confusion_matrix[t.long(), p.long()] += 1
+        update_eval_stats(stats, outputs, labels, criterion, num_classes)
                                 
-    avg_loss = total_loss / len(data_loader.dataset)
-    accuracy = correctly_labeled_samples / len(data_loader.dataset)
-    per_class_accuracy = confusion_matrix.diag() / confusion_matrix.sum(1)
-    return avg_loss, (accuracy, per_class_accuracy)
+    return finish_eval_stats(stats, len(data_loader.dataset), num_classes)
 
 def get_loss_n_accuracy_poison(model, trigger_generator, criterion, val_dataset, args, num_classes=10):
     """ Returns the loss and total accuracy, per class accuracy on the supplied data loader """
     
     # disable BN stats during inference
     model.eval()                                      
-    total_loss, correctly_labeled_samples = 0, 0
-    confusion_matrix = torch.zeros(num_classes, num_classes)
+    stats = new_eval_stats(num_classes, args.device)
             
     # forward-pass to get loss and predictions of the current batch
     if args.attack_mode == 'DBA' or args.attack_mode == 'normal':
@@ -131,18 +142,9 @@ def get_loss_n_accuracy_poison(model, trigger_generator, criterion, val_dataset,
                     poison_labels.to(device=args.device, non_blocking=True)
 
 
-            # compute the total loss over minibatch
+            # accumulate loss, correct predictions and the confusion matrix on device
             outputs = model(inputs)
-            avg_minibatch_loss = criterion(outputs, labels.view(-1,))
-            total_loss += avg_minibatch_loss.item()*outputs.shape[0]
-                            
-            # get num of correctly predicted inputs in the current batch
-            _, pred_labels = torch.max(outputs, 1)
-            pred_labels = pred_labels.view(-1)
-            correctly_labeled_samples += torch.sum(torch.eq(pred_labels, labels.view(-1,))).item()
-            # fill confusion_matrix
-            for t, p in zip(labels.view(-1), pred_labels.view(-1)):
-                confusion_matrix[t.long(), p.long()] += 1
+            update_eval_stats(stats, outputs, labels, criterion, num_classes)
 
     elif args.attack_mode == 'trigger_generation' or args.attack_mode == 'fixed_generator':
         for inputs, labels,_,_  in enumerate_batch(val_dataset, 'benign', args.bs, args, val_mode = True):
@@ -162,24 +164,11 @@ def get_loss_n_accuracy_poison(model, trigger_generator, criterion, val_dataset,
 
             labels = target_transform(labels, args)
 
-            # compute the total loss over minibatch
+            # accumulate loss, correct predictions and the confusion matrix on device
             outputs = model(inputs)
-            avg_minibatch_loss = criterion(outputs, labels.view(-1, ))
-            total_loss += avg_minibatch_loss.item()*outputs.shape[0]
-                            
-            # get num of correctly predicted inputs in the current batch
-            _, pred_labels = torch.max(outputs, 1)
-            pred_labels = pred_labels.view(-1)
-            correctly_labeled_samples += torch.sum(torch.eq(pred_labels, labels.view(-1,))).item()
-            # fill confusion_matrix
-            for t, p in zip(labels.view(-1), pred_labels.view(-1)):
-                confusion_matrix[t.long(), p.long()] += 1
+            update_eval_stats(stats, outputs, labels, criterion, num_classes)
                 
-    avg_loss = total_loss / len(val_dataset)
-    accuracy = correctly_labeled_samples / len(val_dataset)
-    per_class_accuracy = confusion_matrix.diag() / confusion_matrix.sum(1)
-
-    return avg_loss, (accuracy, per_class_accuracy)
+    return finish_eval_stats(stats, len(val_dataset), num_classes)
 
 def get_gradient_of_model(model):
     size = 0
@@ -210,6 +199,127 @@ def cosine_simi_between_two_vector(vector1, vector2):
     criterion = torch.cosine_similarity()
     return 1 - criterion(vector1, vector2)
 
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def seed_local_training(args, rnd, agent_id):
+    """ seeds every random stream from (seed, round, agent), independent of which process trains the agent """
+    seed_everything(int(np.random.SeedSequence([args.seed, rnd, agent_id]).generate_state(1)[0]))
+
+@contextmanager
+def local_training_rng(args, rnd, agent_id):
+    """ runs one agent's local training on its own seeded streams and restores the outer streams afterwards """
+    if args.seed == None:
+        yield
+        return
+    outer_states = get_rng_states()
+    seed_local_training(args, rnd, agent_id)
+    try:
+        yield
+    finally:
+        set_rng_states(outer_states)
+
+def get_rng_states():
+    return random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+def set_rng_states(states):
+    random.setstate(states[0])
+    np.random.set_state(states[1])
+    torch.set_rng_state(states[2])
+
+class LocalTrainingStreams():
+    """ 
+    the (seed, round, agent) streams of local_training_rng for agents that take turns, e.g. a cohort drawing
+    its batches step by step, every agent continues its own stream and the outer streams are left alone
+    """
+    def __init__(self, args, rnd, agent_ids):
+        self.states = None
+        if args.seed == None:
+            return
+        outer_states = get_rng_states()
+        self.states = {}
+        for agent_id in agent_ids:
+            seed_local_training(args, rnd, agent_id)
+            self.states[agent_id] = get_rng_states()
+        set_rng_states(outer_states)
+
+    @contextmanager
+    def turn(self, agent_id):
+        if self.states == None:
+            yield
+            return
+        outer_states = get_rng_states()
+        set_rng_states(self.states[agent_id])
+        try:
+            yield
+        finally:
+            self.states[agent_id] = get_rng_states()
+            set_rng_states(outer_states)
+
+def load_buffers(model, buffers):
+    """ copies saved buffers (e.g. batchnorm running stats) back into the model """
+    with torch.no_grad():
+        for buf, saved_buf in zip(model.buffers(), buffers):
+            buf.copy_(saved_buf)
+
+def accumulate_buffers(buffer_sums, buffers, weight):
+    """ adds weight * buffers (e.g. batchnorm running stats) to the running sums, integer buffers keep their largest value """
+    if buffer_sums is None:
+        return [buf.detach().double() * weight if buf.is_floating_point() else buf.detach().clone() for buf in buffers]
+    for buf_sum, buf in zip(buffer_sums, buffers):
+        if buf.is_floating_point():
+            buf_sum.add_(buf.detach().double(), alpha=weight)
+        else:
+            torch.maximum(buf_sum, buf.detach(), out=buf_sum)
+    return buffer_sums
+
+def load_buffer_mean(model, buffer_sums, total_weight):
+    """ copies the weighted mean of the accumulated buffers into the model """
+    with torch.no_grad():
+        for buf, buf_sum in zip(model.buffers(), buffer_sums):
+            if buf.is_floating_point():
+                buf.copy_(buf_sum / total_weight)
+            else:
+                buf.copy_(buf_sum)
+
+def split_like_parameters(vector, model):
+    """ views of a flat vector shaped like every parameter of the model, nothing is copied """
+    views, offset = [], 0
+    for param in model.parameters():
+        views.append(vector[offset:offset + param.numel()].view_as(param))
+        offset += param.numel()
+    return views
+
+def flatten_parameters(model):
+    """ 
+    copies the parameters of a model into one flat tensor and makes every parameter a view of it,
+    so the whole model can be read or reset with a single copy_, returns the flat tensor
+    """
+    with torch.no_grad():
+        flat_params = parameters_to_vector(model.parameters()).detach().clone()
+        for param, view in zip(model.parameters(), split_like_parameters(flat_params, model)):
+            param.data = view
+    return flat_params
+
+def load_parameters(model, vector):
+    """ writes a flat vector into the parameters in place, unlike vector_to_parameters the views of flatten_parameters survive """
+    with torch.no_grad():
+        for param, view in zip(model.parameters(), split_like_parameters(vector, model)):
+            param.copy_(view)
+
+def project_parameters(params, initial_params, radius):
+    """ 
+    projects the parameters back into the L2 ball of the given radius around initial_params in place,
+    the norm of the update is summed up tensor by tensor so no flat copy of the model is made
+    """
+    with torch.no_grad():
+        sq_norm = sum((param - initial_param).pow(2).sum() for param, initial_param in zip(params, initial_params))
+        clip_denom = (sq_norm.sqrt() / radius).clamp(min=1)
+        for param, initial_param in zip(params, initial_params):
+            param.sub_(initial_param).div_(clip_denom).add_(initial_param)
+
 def compare_images(trigger_model_target, poisoned_val_set, args, round):
     plt.figure(figsize=(12, 6))
     n = 5
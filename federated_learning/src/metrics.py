@@ -0,0 +1,67 @@
+import torch
+import numpy as np
+
+
+class OutputLayer():
+    """
+    where the weight and bias of a model's output layer sit inside a flat update vector,
+    derived once from named_parameters instead of hard-coded offsets, so it works for any number of classes
+    """
+    def __init__(self, model):
+        offsets, offset = {}, 0
+        for name, param in model.named_parameters():
+            offsets[name] = (offset, offset + param.numel(), tuple(param.shape))
+            offset += param.numel()
+        names = list(offsets.keys())
+        # the output layer is the last 2-d weight, its bias is the 1-d parameter right after it
+        weight_name = [name for name in names if len(offsets[name][2]) == 2][-1]
+        self.weight_start, self.weight_end, weight_shape = offsets[weight_name]
+        self.num_classes = weight_shape[0]
+        bias_name = names[names.index(weight_name) + 1] if names.index(weight_name) + 1 < len(names) else None
+        if bias_name != None and offsets[bias_name][2] == (self.num_classes,):
+            self.bias_start, self.bias_end, _ = offsets[bias_name]
+        else:
+            self.bias_start, self.bias_end = None, None
+
+    def weights(self, updates):
+        """ [n, classes, features] output layer weight updates of the [n, d] updates """
+        return updates[:, self.weight_start:self.weight_end].reshape(len(updates), self.num_classes, -1)
+
+    def bias(self, updates):
+        """ [n, classes] output layer bias updates, zeros for a layer without bias """
+        if self.bias_start == None:
+            return updates.new_zeros((len(updates), self.num_classes))
+        return updates[:, self.bias_start:self.bias_end]
+
+#########################NEUP_calc#######################
+def neups_metric(grad_in, output_layer):
+    """NEUPs measures the magnitude changes of neurons in the last layer
+    and use them to provide a rough estimation of the output labels for
+    the training data of the individual client
+    Args:
+        grad_in (np.ndarray/torch.Tensor): the raw input weight_diffs
+        output_layer (OutputLayer): the output layer of the model
+    Returns:
+        [np.ndarray]: 2-dimession NormalizEd Energies UPdate for clients
+    """
+    updates = torch.as_tensor(grad_in)
+    energy_weights = output_layer.weights(updates).abs().sum(dim=2)     #row = num_neuron
+    energy_neuron = torch.square(energy_weights + output_layer.bias(updates).abs())
+    energy_neuron = energy_neuron / energy_neuron.sum(dim=1, keepdim=True)
+
+    return energy_neuron.cpu().numpy()
+
+#########################TE(Threshold Exceedings)_calc#######################
+def te_metric(neups):
+    """TEs analyzes the parameter updates of the output layer for a model
+    to measure the homogeneity of its training data
+    Args:
+        neups ([np.ndarray]): NormalizEd Energies UPdate
+    Returns:
+        [np.ndarray]: the number of threshold exceedings
+    """
+    neups = np.asarray(neups)
+    num_classes = neups.shape[1]
+    threshold = max(0.01, 1 / num_classes) * neups.max(axis=1, keepdims=True)
+
+    return (neups > threshold).sum(axis=1)
@@ -92,7 +92,16 @@ def args_parser():
                         help="number of communication rounds:R")
     
     parser.add_argument('--aggr', type=str, default='avg', 
-                        help="aggregation function to aggregate agents' local weights")
+                        help="aggregation function to aggregate agents' local weights: avg, comed, sign, krum, flame, trimmed_mean, winsorized_mean")
+
+    parser.add_argument('--aggr_block_size', type=int, default=2**20, 
+                        help="number of coordinates stacked at once by comed, trimmed_mean and winsorized_mean")
+
+    parser.add_argument('--trim_ratio', type=float, default=0.1, 
+                        help="fraction of updates trimmed from each end of every coordinate")
+
+    parser.add_argument('--update_dtype', type=str, default='float32', choices=['float32', 'bfloat16', 'float16', 'float64'],
+                        help="dtype agent updates are stored and checkpointed in: float32, bfloat16, float16, float64")
 
     parser.add_argument('--krum_selected_number', type=int, default=1, 
                         help="default number is one krum")
@@ -165,6 +174,48 @@ def args_parser():
     
     parser.add_argument('--num_workers', type=int, default=0, 
                         help="num of workers for multithreading")
+
+    parser.add_argument('--client_workers', type=int, default=0, 
+                        help="number of worker processes training agents in parallel (cpu only), 0 trains them one after another")
+
+    parser.add_argument('--cohort_size', type=int, default=0, 
+                        help="number of benign agents trained together as one vmapped model, 0 trains them one after another")
+
+    parser.add_argument('--imagenet_flip', type=bool, default=False, 
+                        help="randomly flip tiny-imagenet training batches horizontally")
+
+    parser.add_argument('--imagenet_normalize', type=bool, default=False, 
+                        help="normalize tiny-imagenet batches with the imagenet mean and std")
+
+    parser.add_argument('--resident_data', type=bool, default=False, 
+                        help="transform the datasets once and keep them as tensors, every agent gets a contiguous shard")
+
+    parser.add_argument('--dataset_cache_dir', type=str, default=None, 
+                        help="dir of the memory-mapped cache of preprocessed datasets, written on first use and shared by later runs")
+
+    parser.add_argument('--partition_cache_dir', type=str, default=None, 
+                        help="dir of the cached agent partitions, only used by seeded runs")
+
+    parser.add_argument('--async_eval', type=bool, default=False, 
+                        help="evaluate the snap rounds on a background thread with its own model replica")
+
+    parser.add_argument('--flame_lambda', type=float, default=0.001, 
+                        help="flame noise level, the std of the noise added to the aggregate is flame_lambda times the median update norm")
+
+    parser.add_argument('--sketch', type=str, default='none', choices=['none', 'gaussian', 'sparse', 'countsketch'],
+                        help="krum and flame decide on k-dimensional sketches of the updates: none, gaussian, sparse, countsketch")
+
+    parser.add_argument('--sketch_eps', type=float, default=0.1, 
+                        help="distance error bound of the sketches, decisions within the bound of the dimension used fall back to exact distances")
+
+    parser.add_argument('--sketch_dim', type=int, default=0, 
+                        help="dimension k of the sketches, 0 derives it from sketch_eps and the agents per round, a k that gives no bound or costs more than exact is refused")
+
+    parser.add_argument('--sketch_sparsity', type=int, default=0, 
+                        help="nonzeros per coordinate of the sparse sketch, 0 derives it from sketch_eps and the agents per round")
+
+    parser.add_argument('--seed', type=int, default=None, 
+                        help="seed of the run, every agent's local training is seeded from (seed, round, agent)")
     
     args = parser.parse_args()
     return args
\ No newline at end of file
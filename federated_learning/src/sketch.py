@@ -0,0 +1,192 @@
+import math
+import torch
+
+
+def sketch_dim(n_points, eps):
+    """ Johnson-Lindenstrauss dimension that keeps all pairwise squared distances of n_points within (1 +- eps) """
+    return math.ceil(4 * math.log(max(n_points, 2)) / (eps ** 2 / 2 - eps ** 3 / 3))
+
+def gaussian_eps(n_points, dim):
+    """ the eps sketch_dim gives dim for, i.e. the JL bound of a dim-dimensional gaussian sketch, 1 if it has none """
+    target = 4 * math.log(max(n_points, 2)) / dim
+    # eps^2 / 2 - eps^3 / 3 grows on (0, 1) up to 1/6
+    if target >= 1 / 6:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(60):
+        mid = (low + high) / 2
+        if mid ** 2 / 2 - mid ** 3 / 3 < target:
+            low = mid
+        else:
+            high = mid
+    return high
+
+def sparse_sparsity(n_points, eps):
+    """ 
+    nonzeros per coordinate a sparse JL sketch (Kane-Nelson block construction) needs on top of the JL dimension,
+    s = O(log(1/delta) / eps) with delta = 1/n^2 per pair, the same confidence sketch_dim gives
+    """
+    return math.ceil(2 * math.log(max(n_points, 2)) / eps)
+
+def sparse_eps(n_points, dim, sparsity):
+    """ the sparse JL bound of a dim-dimensional sketch with sparsity nonzeros per coordinate """
+    return max(gaussian_eps(n_points, dim), 2 * math.log(max(n_points, 2)) / sparsity)
+
+def chebyshev_dim(n_points, eps):
+    """ 
+    dimension a count sketch (one nonzero per coordinate) needs, it only bounds the variance,
+    Var(|Sx|^2) <= 2|x|^4 / k, so Chebyshev and a union bound over the n(n-1)/2 pairs at 1 - 1/n set k
+    """
+    n_points = max(n_points, 2)
+    return math.ceil(n_points ** 2 * (n_points - 1) / eps ** 2)
+
+def chebyshev_eps(n_points, dim):
+    """ the eps chebyshev_dim gives dim for """
+    n_points = max(n_points, 2)
+    return math.sqrt(n_points ** 2 * (n_points - 1) / dim)
+
+
+class UpdateSketcher():
+    """
+    maps every update to k dimensions as it arrives, with a projection that is never stored:
+    its columns are regenerated chunk by chunk from a (seed, round, chunk) generator, so all updates
+    of a round share the same projection and the next round gets a fresh one.
+    gaussian is the dense JL projection, O(kd) per update, sparse hashes every coordinate into
+    sketch_sparsity buckets with random signs (one per block of k / s rows), countsketch is the s = 1 case,
+    both O(sd) per update. eps is the bound that holds for the kind, dimension and sparsity actually used:
+    JL for gaussian, sparse JL for sparse and Chebyshev for countsketch, which has no O(log n) dimension
+    """
+    def __init__(self, n_params, args):
+        self.kind = args.sketch
+        self.n_params = n_params
+        self.n_points = math.floor(args.num_agents * args.agent_frac)
+        if args.sketch_dim > 0:
+            dim = args.sketch_dim
+        elif self.kind == 'countsketch':
+            dim = chebyshev_dim(self.n_points, args.sketch_eps)
+        else:
+            dim = sketch_dim(self.n_points, args.sketch_eps)
+        self.sparsity = None
+        if self.kind == 'sparse':
+            self.sparsity = args.sketch_sparsity if args.sketch_sparsity > 0 else sparse_sparsity(self.n_points, args.sketch_eps)
+        elif self.kind == 'countsketch':
+            self.sparsity = 1
+        if self.sparsity != None:
+            # one bucket per block of rows, so a coordinate never lands in the same row twice
+            dim = self.sparsity * math.ceil(dim / self.sparsity)
+        self.dim = dim
+        if self.kind == 'gaussian':
+            self.eps = gaussian_eps(self.n_points, self.dim)
+        elif self.kind == 'sparse':
+            self.eps = min(sparse_eps(self.n_points, self.dim, self.sparsity), chebyshev_eps(self.n_points, self.dim))
+        else:
+            self.eps = chebyshev_eps(self.n_points, self.dim)
+        # a chunk of the projection holds about aggr_block_size entries
+        self.chunk_columns = max(1, args.aggr_block_size // (self.dim if self.kind == 'gaussian' else self.sparsity))
+        self.base_seed = args.seed if args.seed != None else 0
+
+    def unsuitable(self):
+        """ why the sketch would not beat the exact distances of the round, None if it does """
+        if self.eps >= 1:
+            return 'a {}-dimensional {} sketch bounds no distance of {} updates'.format(self.dim, self.kind, self.n_points)
+        # the exact gram of a round costs n^2 d, the sketches n k d (gaussian) or n s d (hashing) plus their n^2 k gram
+        exact_cost = self.n_points ** 2 * self.n_params
+        per_update = self.dim if self.kind == 'gaussian' else self.sparsity
+        sketch_cost = self.n_points * per_update * self.n_params + self.n_points ** 2 * self.dim
+        if sketch_cost >= exact_cost:
+            return 'a {}-dimensional {} sketch costs more than the exact distances of {} updates'.format(self.dim, self.kind, self.n_points)
+        return None
+
+    def chunk_generator(self, rnd, chunk_index, device):
+        generator = torch.Generator(device=device)
+        generator.manual_seed(((self.base_seed * 1000003 + rnd) * 1000003 + chunk_index) % 2**63)
+        return generator
+
+    def sketch(self, update, rnd):
+        """ the [k] sketch of one [d] update """
+        sketch = torch.zeros(self.dim, dtype=torch.float32, device=update.device)
+        for chunk_index, start in enumerate(range(0, self.n_params, self.chunk_columns)):
+            chunk = update[start:start + self.chunk_columns].float()
+            generator = self.chunk_generator(rnd, chunk_index, update.device)
+            if self.kind == 'gaussian':
+                projection = torch.randn(self.dim, len(chunk), generator=generator, device=update.device)
+                sketch.addmv_(projection, chunk)
+            else:
+                sketch.index_add_(0, *self.hashed(chunk, generator))
+        if self.kind == 'gaussian':
+            sketch.div_(math.sqrt(self.dim))
+        return sketch
+
+    def hashed(self, chunk, generator):
+        """ bucket and signed, scaled value of every coordinate of the chunk in each of the sparsity blocks """
+        block_len = self.dim // self.sparsity
+        shape = (self.sparsity, len(chunk))
+        buckets = torch.randint(block_len, shape, generator=generator, device=chunk.device)
+        buckets += torch.arange(self.sparsity, device=chunk.device).unsqueeze(1) * block_len
+        signs = torch.randint(2, shape, generator=generator, device=chunk.device) * 2 - 1
+        values = signs * chunk / math.sqrt(self.sparsity)
+        return buckets.flatten(), values.flatten()
+
+
+def exact_row_gram(updates, rows, block_size):
+    """ exact inner products [r, n] of the given rows with every update and the squared norms [n], in float64 over column blocks """
+    n_params = updates[0].numel()
+    gram_rows = torch.zeros(len(rows), len(updates), dtype=torch.float64, device=updates[0].device)
+    sq_norms = torch.zeros(len(updates), dtype=torch.float64, device=updates[0].device)
+    for start in range(0, n_params, block_size):
+        block = torch.stack([update[start:start + block_size] for update in updates], dim=0).double()
+        gram_rows.addmm_(block[rows], block.T)
+        sq_norms.add_(block.square().sum(dim=1))
+    return gram_rows, sq_norms
+
+def exact_row_euclidean(updates, rows, block_size):
+    """ exact L2 distances [r, n] from the given rows to every update """
+    gram_rows, sq_norms = exact_row_gram(updates, rows, block_size)
+    sq_distances = sq_norms[rows].unsqueeze(1) + sq_norms.unsqueeze(0) - 2 * gram_rows
+    sq_distances[torch.arange(len(rows)), rows] = 0
+    return sq_distances.clamp_(min=0).sqrt()
+
+def exact_row_cosine_distance(updates, rows, block_size):
+    """ exact cosine distances [r, n] from the given rows to every update, same semantics as UpdateGeometry.cosine_distance """
+    gram_rows, sq_norms = exact_row_gram(updates, rows, block_size)
+    norms = sq_norms.clamp(min=0).sqrt()
+    norms = torch.where(norms == 0, torch.ones_like(norms), norms)
+    distances = (1 - gram_rows / norms[rows].unsqueeze(1) / norms.unsqueeze(0)).clamp_(0, 2)
+    distances[torch.arange(len(rows)), rows] = 0
+    return distances
+
+def make_sketcher(n_params, args):
+    """ the UpdateSketcher of the run, refuses a sketch that bounds nothing or is slower than the exact distances """
+    sketcher = UpdateSketcher(n_params, args)
+    reason = sketcher.unsuitable()
+    if reason != None:
+        raise ValueError('--sketch {}: {}, raise --sketch_eps, try --sketch sparse or use --sketch none'.format(args.sketch, reason))
+    return sketcher
+
+def krum_borderline(scores, selected_number, eps):
+    """
+    splits the sketched krum scores into the rows that are selected whatever the sketch error,
+    and the borderline rows whose exact score decides the remaining slots.
+    every sketched distance is within (1 +- eps) of the squared distance, so the true score of a row
+    lies in [score / sqrt(1 + eps), score / sqrt(1 - eps)]
+    """
+    lower = scores / math.sqrt(1 + eps)
+    upper = scores / math.sqrt(1 - eps)
+    # rows that can beat row i, and rows that beat it in any case, itself excluded
+    can_beat = (lower.unsqueeze(0) < upper.unsqueeze(1)).sum(dim=1) - 1
+    must_beat = (upper.unsqueeze(0) < lower.unsqueeze(1)).sum(dim=1)
+    certain = torch.nonzero(can_beat < selected_number).flatten()
+    borderline = torch.nonzero((can_beat >= selected_number) & (must_beat < selected_number)).flatten()
+    return certain, borderline
+
+def flame_borderline(distances, accepted, margin):
+    """ rows whose nearest accepted and nearest rejected neighbour are within margin of each other on the sketches """
+    accepted_mask = torch.zeros(distances.shape[0], dtype=torch.bool, device=distances.device)
+    accepted_mask[accepted] = True
+    if accepted_mask.all() or not accepted_mask.any():
+        return torch.zeros(0, dtype=torch.long, device=distances.device)
+    distances = distances.clone()
+    distances.fill_diagonal_(float('inf'))
+    nearest_accepted = distances[:, accepted_mask].min(dim=1).values
+    nearest_rejected = distances[:, ~accepted_mask].min(dim=1).values
+    return torch.nonzero((nearest_accepted - nearest_rejected).abs() < margin).flatten()
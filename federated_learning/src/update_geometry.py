@@ -0,0 +1,90 @@
+import torch
+
+
+class UpdateGeometry():
+    """
+    pairwise geometry of the updates of one round, created once from the stacked [n, d] updates,
+    the Gram matrix and everything derived from it (norms, cosine and euclidean distances) are
+    computed on the device the first time they are asked for and memoized, so every defence that
+    shares the object pays for the O(n^2 d) product only once
+    """
+    def __init__(self, stacked_updates, block_size=2**20, model=None):
+        self.stacked_updates = stacked_updates
+        self.block_size = block_size
+        self.memo = {}
+        self.slices = {}
+        # flat offsets of every parameter of the model, for the per-layer geometry
+        self.layer_offsets = {}
+        if model != None:
+            offset = 0
+            for name, param in model.named_parameters():
+                self.layer_offsets[name] = (offset, offset + param.numel())
+                offset += param.numel()
+
+    def __len__(self):
+        return self.stacked_updates.shape[0]
+
+    def memoized(self, key, compute):
+        if key not in self.memo:
+            self.memo[key] = compute()
+        return self.memo[key]
+
+    def gram(self):
+        """ [n, n] inner products, accumulated in float64 over column blocks """
+        def compute():
+            update_len, n_params = self.stacked_updates.shape
+            gram = torch.zeros(update_len, update_len, dtype=torch.float64, device=self.stacked_updates.device)
+            for start in range(0, n_params, self.block_size):
+                block = self.stacked_updates[:, start:start + self.block_size].double()
+                gram.addmm_(block, block.T)
+            return gram
+        return self.memoized('gram', compute)
+
+    def norms(self):
+        """ L2 norm of every update """
+        return self.memoized('norms', lambda: self.gram().diagonal().clamp(min=0).sqrt())
+
+    def squared_euclidean(self):
+        """ squared L2 distances, norms and cross terms cancel in float64 """
+        def compute():
+            sq_norms = self.gram().diagonal()
+            sq_distances = sq_norms.unsqueeze(0) + sq_norms.unsqueeze(1) - 2 * self.gram()
+            sq_distances.fill_diagonal_(0)
+            return sq_distances.clamp_(min=0)
+        return self.memoized('squared_euclidean', compute)
+
+    def euclidean(self):
+        return self.memoized('euclidean', lambda: self.squared_euclidean().sqrt())
+
+    def cosine_similarity(self):
+        """ a zero update is orthogonal to everything, like in sklearn """
+        def compute():
+            norms = self.norms()
+            norms = torch.where(norms == 0, torch.ones_like(norms), norms)
+            return self.gram() / norms.unsqueeze(0) / norms.unsqueeze(1)
+        return self.memoized('cosine_similarity', compute)
+
+    def cosine_distance(self):
+        """ 1 - cosine similarity, clipped to [0, 2] with a zero diagonal, same as sklearn's metric='cosine' """
+        def compute():
+            distances = (1 - self.cosine_similarity()).clamp_(0, 2)
+            distances.fill_diagonal_(0)
+            return distances
+        return self.memoized('cosine_distance', compute)
+
+    def slice(self, start, end):
+        """ the geometry of the coordinates [start, end) of every update, memoized as well """
+        if (start, end) not in self.slices:
+            self.slices[(start, end)] = UpdateGeometry(self.stacked_updates[:, start:end], self.block_size)
+        return self.slices[(start, end)]
+
+    def layer(self, name):
+        """ the geometry of one parameter of the model the object was created with """
+        return self.slice(*self.layer_offsets[name])
+
+
+def as_geometry(grad_in, block_size=2**20):
+    """ lets the defences take either a shared UpdateGeometry or the raw [n, d] updates """
+    if isinstance(grad_in, UpdateGeometry):
+        return grad_in
+    return UpdateGeometry(torch.as_tensor(grad_in), block_size)